@@ -1,5 +1,18 @@
+import os
+import json
+import hashlib
+import argparse
 import subprocess
 import struct
+import multiprocessing
+import numpy as np
+
+
+BASIC_KINDS = ["WAVEFORM", "LPC", "LPREFC", "LPCEPSTRA", "LPDELCEP", "IREFC",
+               "MFCC", "FBANK", "MELSPEC", "USER", "DISCRETE", "PLP"]
+
+QUALIFIERS = [(0o100, "E"), (0o200, "N"), (0o400, "D"), (0o1000, "A"), (0o2000, "C"),
+              (0o4000, "Z"), (0o10000, "K"), (0o20000, "0"), (0o40000, "V"), (0o100000, "T")]
 
 
 def HCopy(conf, wav, htk):
@@ -19,6 +32,123 @@ def HCopy(conf, wav, htk):
     return output
 
 
+def _hcopy_job(job):
+    """ Pool worker: converts one file and returns its report entry. """
+    conf, wav, htk = job
+    entry = {'wav': wav, 'htk': htk, 'status': 'ok', 'error': None}
+    try:
+        subprocess.check_output(["HCopy", "-C", conf, wav, htk], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        entry['status'] = 'failed'
+        entry['error'] = e.output.decode(errors='replace').strip() or str(e)
+    except OSError as e:
+        entry['status'] = 'failed'
+        entry['error'] = str(e)
+    return entry
+
+
+def _list_jobs(source, output_dir, ext):
+    """ Lists (wav, htk) pairs from a directory of wavs or from a filelist.
+        Filelist lines hold either a wav path or an HTK script style "wav htk" pair.
+    """
+    pairs = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith('.wav'):
+                pairs.append((os.path.join(source, name),
+                              os.path.join(output_dir, os.path.splitext(name)[0] + ext)))
+    else:
+        with open(source, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 1:
+                    name = os.path.splitext(os.path.basename(fields[0]))[0]
+                    pairs.append((fields[0], os.path.join(output_dir, name + ext)))
+                elif len(fields) >= 2:
+                    pairs.append((fields[0], fields[1]))
+    return pairs
+
+
+def HCopyBatch(conf, source, output_dir, workers=None, manifest='hcopy_manifest.json', ext='.mfc'):
+    """ Runs HCopy over many files on a bounded process pool.
+        Outputs whose source mtime/size and configuration are unchanged since the last run are skipped.
+        Args:
+            conf (string): Path to configuration file.
+            source (string): Directory with .wav files or filelist path.
+            output_dir (string): Directory for the HTK files (and the manifest).
+            workers (int): Number of processes, defaults to the number of cores.
+            manifest (string): Manifest file name inside output_dir, None disables skipping.
+            ext (string): Extension of the HTK files.
+        Returns:
+            list: One dict per file with keys wav, htk, status ('ok', 'skipped', 'failed') and error.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(conf, 'rb') as f:
+        conf_hash = hashlib.sha1(f.read()).hexdigest()
+
+    manifest_path = os.path.join(output_dir, manifest) if manifest else None
+    records = {}
+    if manifest_path and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            records = json.load(f)
+
+    report = []
+    jobs = []
+    stamps = {}
+    for wav, htk in _list_jobs(source, output_dir, ext):
+        try:
+            st = os.stat(wav)
+        except OSError as e:
+            report.append({'wav': wav, 'htk': htk, 'status': 'failed', 'error': str(e)})
+            continue
+        stamps[htk] = {'wav': wav, 'mtime': st.st_mtime, 'size': st.st_size, 'conf': conf_hash}
+        if records.get(htk) == stamps[htk] and os.path.exists(htk):
+            report.append({'wav': wav, 'htk': htk, 'status': 'skipped', 'error': None})
+        else:
+            jobs.append((conf, wav, htk))
+
+    if jobs:
+        pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+        try:
+            for entry in pool.imap_unordered(_hcopy_job, jobs, chunksize=4):
+                report.append(entry)
+                if entry['status'] == 'ok':
+                    records[entry['htk']] = stamps[entry['htk']]
+                else:
+                    records.pop(entry['htk'], None)
+        finally:
+            pool.close()
+            pool.join()
+            if manifest_path:
+                with open(manifest_path, 'w') as f:
+                    json.dump(records, f, indent=1)
+
+    return report
+
+
+def parameter_kind(kind):
+    """ Converts an HTK parameter kind name (e.g. "MFCC_E_D_A") to its integer code. """
+    fields = kind.upper().split("_")
+    code = BASIC_KINDS.index(fields[0])
+    flags = dict((q, flag) for flag, q in QUALIFIERS)
+    for qualifier in fields[1:]:
+        code |= flags[qualifier]
+    return code
+
+
+def compression_factors(data):
+    """ Computes the per-feature HTK compression factors of a (nSamples, nFeatures) array.
+        Values are stored as round(x * A - B) and recovered as (s + B) / A.
+    """
+    xmax = data.max(axis=0).astype(np.float64)
+    xmin = data.min(axis=0).astype(np.float64)
+    span = np.where(xmax > xmin, xmax - xmin, 1.0)
+    A = 2 * 32767.0 / span
+    B = (xmax + xmin) * 32767.0 / span
+    return A.astype(np.float32), B.astype(np.float32)
+
+
 class HTKFile:
     """ Class to load binary HTK file.
         Details on the format can be found online in HTK Book chapter 5.7.1.
@@ -34,73 +164,32 @@ class HTKFile:
     sampPeriod = 0
     basicKind = None
     qualifiers = None
+    _A = None
+    _B = None
 
-    def load(self, filename):
+    def load(self, filename, mmap=False):
         """ Loads HTK file.
+            The whole body is decoded with a single NumPy operation using big-endian dtypes.
             After loading the file you can check the following members:
-                data (matrix) - data contained in the file
+                data (ndarray) - float32 data contained in the file, shape (nSamples, nFeatures)
                 nSamples (int) - number of frames in the file
                 nFeatures (int) - number if features per frame
                 sampPeriod (int) - sample period in 100ns units (e.g. fs=16 kHz -> 625)
                 basicKind (string) - basic feature kind saved in the file
                 qualifiers (string) - feature options present in the file
+            Args:
+                filename (string): Path to HTK file.
+                mmap (bool): If True the body is memory-mapped instead of read up front. In that case
+                    data holds the raw np.memmap and frames() must be used to get decoded values.
+            Returns:
+                ndarray: The loaded data.
         """
         with open(filename, "rb") as f:
-
             header = f.read(12)
             self.nSamples, self.sampPeriod, sampSize, paramKind = struct.unpack(">iihh", header)
-            basicParameter = paramKind & 0x3F
-
-            if basicParameter is 0:
-                self.basicKind = "WAVEFORM"
-            elif basicParameter is 1:
-                self.basicKind = "LPC"
-            elif basicParameter is 2:
-                self.basicKind = "LPREFC"
-            elif basicParameter is 3:
-                self.basicKind = "LPCEPSTRA"
-            elif basicParameter is 4:
-                self.basicKind = "LPDELCEP"
-            elif basicParameter is 5:
-                self.basicKind = "IREFC"
-            elif basicParameter is 6:
-                self.basicKind = "MFCC"
-            elif basicParameter is 7:
-                self.basicKind = "FBANK"
-            elif basicParameter is 8:
-                self.basicKind = "MELSPEC"
-            elif basicParameter is 9:
-                self.basicKind = "USER"
-            elif basicParameter is 10:
-                self.basicKind = "DISCRETE"
-            elif basicParameter is 11:
-                self.basicKind = "PLP"
-            else:
-                self.basicKind = "ERROR"
-
-            self.qualifiers = []
-            if (paramKind & 0o100) != 0:
-                self.qualifiers.append("E")
-            if (paramKind & 0o200) != 0:
-                self.qualifiers.append("N")
-            if (paramKind & 0o400) != 0:
-                self.qualifiers.append("D")
-            if (paramKind & 0o1000) != 0:
-                self.qualifiers.append("A")
-            if (paramKind & 0o2000) != 0:
-                self.qualifiers.append("C")
-            if (paramKind & 0o4000) != 0:
-                self.qualifiers.append("Z")
-            if (paramKind & 0o10000) != 0:
-                self.qualifiers.append("K")
-            if (paramKind & 0o20000) != 0:
-                self.qualifiers.append("0")
-            if (paramKind & 0o40000) != 0:
-                self.qualifiers.append("V")
-            if (paramKind & 0o100000) != 0:
-                self.qualifiers.append("T")
-
-            if "C" in self.qualifiers or "V" in self.qualifiers or self.basicKind is "IREFC" or self.basicKind is "WAVEFORM":
+            self._parse_kind(paramKind)
+
+            if "C" in self.qualifiers or "V" in self.qualifiers or self.basicKind in ("IREFC", "WAVEFORM"):
                 self.nFeatures = sampSize // 2
             else:
                 self.nFeatures = sampSize // 4
@@ -111,40 +200,111 @@ class HTKFile:
             if "V" in self.qualifiers:
                 raise NotImplementedError("VQ is not implemented")
 
-            self.data = []
-            if self.basicKind is "IREFC" or self.basicKind is "WAVEFORM":
-                for x in range(self.nSamples):
-                    s = f.read(sampSize)
-                    frame = []
-                    for v in range(self.nFeatures):
-                        val = struct.unpack_from(">h", s, v * 2)[0] / 32767.0
-                        frame.append(val)
-                    self.data.append(frame)
+            self._A = None
+            self._B = None
+            offset = 12
+            if self.basicKind in ("IREFC", "WAVEFORM"):
+                dtype = np.dtype(">i2")
             elif "C" in self.qualifiers:
+                dtype = np.dtype(">i2")
+                self._A = np.fromfile(f, dtype=">f4", count=self.nFeatures).astype(np.float32)
+                self._B = np.fromfile(f, dtype=">f4", count=self.nFeatures).astype(np.float32)
+                offset += self.nFeatures * 8
+            else:
+                dtype = np.dtype(">f4")
 
-                A = []
-                s = f.read(self.nFeatures * 4)
-                for x in range(self.nFeatures):
-                    A.append(struct.unpack_from(">f", s, x * 4)[0])
-                B = []
-                s = f.read(self.nFeatures * 4)
-                for x in range(self.nFeatures):
-                    B.append(struct.unpack_from(">f", s, x * 4)[0])
-
-                for x in range(self.nSamples):
-                    s = f.read(sampSize)
-                    frame = []
-                    for v in range(self.nFeatures):
-                        frame.append((struct.unpack_from(">h", s, v * 2)[0] + B[v]) / A[v])
-                    self.data.append(frame)
+            shape = (self.nSamples, self.nFeatures)
+            if mmap:
+                self.data = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape)
             else:
-                for x in range(self.nSamples):
-                    s = f.read(sampSize)
-                    frame = []
-                    for v in range(self.nFeatures):
-                        val = struct.unpack_from(">f", s, v * 4)
-                        frame.append(val[0])
-                    self.data.append(frame)
+                raw = np.fromfile(f, dtype=dtype, count=self.nSamples * self.nFeatures).reshape(shape)
+                self.data = self._decode(raw)
 
             if "K" in self.qualifiers:
-                print("CRC checking not implememnted...")
\ No newline at end of file
+                print("CRC checking not implememnted...")
+
+        return self.data
+
+    def save(self, filename, data=None, sampPeriod=None, kind=None, compressed=False):
+        """ Saves frames as an HTK file readable by load.
+            Args:
+                filename (string): Path to output HTK file.
+                data (ndarray): Frames with shape (nSamples, nFeatures). Defaults to the loaded data.
+                sampPeriod (int): Sample period in 100ns units. Defaults to the loaded one.
+                kind (string): Parameter kind, e.g. "MFCC_E_D_A". Defaults to the loaded one.
+                compressed (bool): Write the "C" layout, int16 values with per-feature A/B scaling.
+        """
+        if data is None:
+            data = self.frames()
+        data = np.asarray(data, dtype=np.float32)
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        if sampPeriod is None:
+            sampPeriod = self.sampPeriod
+        if kind is None:
+            kind = "_".join([self.basicKind] + [q for q in self.qualifiers if q not in ("C", "K")])
+        paramKind = parameter_kind(kind) & ~0o2000 & ~0o10000
+        nSamples, nFeatures = data.shape
+
+        with open(filename, "wb") as f:
+            if compressed:
+                A, B = compression_factors(data)
+                f.write(struct.pack(">iihH", nSamples + 4, int(sampPeriod), nFeatures * 2, paramKind | 0o2000))
+                A.astype(">f4").tofile(f)
+                B.astype(">f4").tofile(f)
+                # float64 product of the stored float32 factors, clipped as the
+                # float32 rounding of A and B can push the extremes past 32767
+                scaled = np.round(data.astype(np.float64) * A.astype(np.float64) - B.astype(np.float64))
+                np.clip(scaled, -32767, 32767).astype(">i2").tofile(f)
+            else:
+                f.write(struct.pack(">iihH", nSamples, int(sampPeriod), nFeatures * 4, paramKind))
+                data.astype(">f4").tofile(f)
+
+    def frames(self, start=0, stop=None):
+        """ Returns decoded float32 frames [start, stop) of the loaded file.
+            Works on both loading modes, with mmap only the requested frames are read from disk.
+        """
+        if self.data is None:
+            raise ValueError("No HTK file loaded")
+        raw = self.data[start:stop]
+        if isinstance(self.data, np.memmap):
+            return self._decode(raw)
+        return raw
+
+    def _decode(self, raw):
+        """ Converts raw big-endian sample values to a native float32 array. """
+        if self.basicKind in ("IREFC", "WAVEFORM"):
+            return raw.astype(np.float32) / np.float32(32767.0)
+        elif self._A is not None:
+            return (raw.astype(np.float32) + self._B) / self._A
+        return raw.astype(np.float32)
+
+    def _parse_kind(self, paramKind):
+        """ Fills basicKind and qualifiers from the HTK parameter kind code. """
+        basicParameter = paramKind & 0x3F
+        if basicParameter < len(BASIC_KINDS):
+            self.basicKind = BASIC_KINDS[basicParameter]
+        else:
+            self.basicKind = "ERROR"
+
+        self.qualifiers = []
+        for flag, qualifier in QUALIFIERS:
+            if (paramKind & flag) != 0:
+                self.qualifiers.append(qualifier)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Batch HCopy Tool")
+    parser.add_argument('config', help='HCopy configuration file')
+    parser.add_argument('input', help='Directory with .wav files or filelist')
+    parser.add_argument('output', help='Directory to save the HTK files')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes')
+    parser.add_argument('--ext', default='.mfc', help='Extension of the HTK files')
+    args = parser.parse_args()
+
+    report = HCopyBatch(args.config, args.input, args.output, args.workers, ext=args.ext)
+    for entry in report:
+        if entry['status'] == 'failed':
+            print('FAILED {}: {}'.format(entry['wav'], entry['error']))
+    for status in ('ok', 'skipped', 'failed'):
+        print('{}: {}'.format(status, sum(1 for e in report if e['status'] == status)))
@@ -0,0 +1,113 @@
+from keras.layers import (Conv2D, SeparableConv2D, Dropout, MaxPooling2D, Dense,
+                          GlobalAveragePooling2D, Flatten, BatchNormalization)
+from keras.layers.advanced_activations import LeakyReLU
+from keras.models import Sequential
+from keras.regularizers import l2
+
+# Registry of the CNN architectures trained by birddet_baseline.py, selected
+# by name (ARCHITECTURE). All of them take (frames, bins, 1) spectrograms and
+# end with one sigmoid unit; profile_models.py compares their cost.
+
+# ---- ARCHITECTURES ---- #
+#   baseline  : 4 x (3x3 conv, BN, LeakyReLU, max pooling), flatten, dense 256-32-1
+#   strided   : first convolution with stride 3 instead of conv + 3x3 pooling
+#   separable : depthwise separable convolutions after the first one
+#   global_pool : baseline convolutions, global average pooling and a dense 32-1 head
+ALPHA = .001
+# ----------------------- #
+
+
+def _conv_block(model, pool_size, layer=Conv2D, **kwargs):
+    model.add(layer(16, (3, 3), **kwargs))
+    model.add(BatchNormalization())
+    model.add(LeakyReLU(alpha=ALPHA))
+    if pool_size is not None:
+        model.add(MaxPooling2D(pool_size=pool_size))
+
+
+def _head(model, pooling, units):
+    """ Pooling ('flatten' or 'global') of the feature maps and the dense layers. """
+    if pooling == 'global':
+        model.add(GlobalAveragePooling2D())
+    else:
+        model.add(Flatten())
+    for n in units:
+        model.add(Dropout(0.5))
+        model.add(Dense(n))
+        model.add(BatchNormalization())
+        model.add(LeakyReLU(alpha=ALPHA))
+    model.add(Dropout(0.5))
+    model.add(Dense(1, activation='sigmoid'))
+
+
+def baseline(input_shape, pooling='flatten'):
+    model = Sequential()
+    _conv_block(model, (3, 3), padding='valid', input_shape=input_shape)
+    _conv_block(model, (3, 3), padding='valid')
+    _conv_block(model, (3, 1), padding='valid')
+    _conv_block(model, (3, 1), padding='valid', kernel_regularizer=l2(0.01))
+    _head(model, pooling, (256, 32))
+    return model
+
+
+def strided(input_shape, pooling='flatten'):
+    """ The first convolution runs on every third frame and bin, 9 times less
+        work than the full resolution convolution and pooling of the baseline.
+    """
+    model = Sequential()
+    model.add(Conv2D(16, (5, 5), strides=(3, 3), padding='same', input_shape=input_shape))
+    model.add(BatchNormalization())
+    model.add(LeakyReLU(alpha=ALPHA))
+    _conv_block(model, (3, 3), padding='valid')
+    _conv_block(model, (3, 1), padding='valid')
+    _conv_block(model, (3, 1), padding='valid', kernel_regularizer=l2(0.01))
+    _head(model, pooling, (256, 32))
+    return model
+
+
+def separable(input_shape, pooling='flatten'):
+    """ Depthwise 3x3 and pointwise 1x1 convolutions after the first layer
+        (which has a single input channel, so nothing to separate).
+    """
+    model = Sequential()
+    _conv_block(model, (3, 3), padding='valid', input_shape=input_shape)
+    _conv_block(model, (3, 3), SeparableConv2D, padding='valid')
+    _conv_block(model, (3, 1), SeparableConv2D, padding='valid')
+    _conv_block(model, (3, 1), SeparableConv2D, padding='valid', pointwise_regularizer=l2(0.01))
+    _head(model, pooling, (256, 32))
+    return model
+
+
+def global_pool(input_shape, pooling='global'):
+    model = Sequential()
+    _conv_block(model, (3, 3), padding='valid', input_shape=input_shape)
+    _conv_block(model, (3, 3), padding='valid')
+    _conv_block(model, (3, 1), padding='valid')
+    _conv_block(model, (3, 1), padding='valid', kernel_regularizer=l2(0.01))
+    _head(model, pooling, (32,))
+    return model
+
+
+ARCHITECTURES = {
+    'baseline': baseline,
+    'strided': strided,
+    'separable': separable,
+    'global_pool': global_pool,
+}
+
+
+def build_model(name, input_shape, pooling=None):
+    """ Builds a registered architecture.
+        Args:
+            name (string): Key of ARCHITECTURES.
+            input_shape (tuple): (frames, bins, 1), frames None for any length.
+            pooling (string): 'flatten' or 'global', the architecture default if None.
+                Inputs of any length need 'global'.
+        Returns:
+            Sequential: The uncompiled model.
+    """
+    if name not in ARCHITECTURES:
+        raise ValueError('Unknown architecture {}, choose from {}'.format(name, sorted(ARCHITECTURES)))
+    if pooling is None:
+        return ARCHITECTURES[name](input_shape)
+    return ARCHITECTURES[name](input_shape, pooling)
@@ -0,0 +1,140 @@
+import os
+import hashlib
+from fractions import Fraction
+import numpy as np
+from scipy.signal import resample_poly
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+# Audio decoding for the feature extraction: PCM is read at its native rate
+# and resampled at most once with a polyphase filter.
+
+
+def read_audio(path):
+    """ Reads a mono float32 signal at the native sample rate of the file.
+        Returns:
+            (ndarray, int): Samples and sample rate.
+    """
+    if soundfile is not None:
+        x, fs = soundfile.read(path, dtype='float32', always_2d=True)
+        x = x.mean(axis=1) if x.shape[1] > 1 else x[:, 0]
+    else:
+        import librosa
+        x, fs = librosa.load(path, sr=None, mono=True)
+    return np.ascontiguousarray(x, dtype=np.float32), fs
+
+
+def resample(x, fs, target_fs):
+    """ Polyphase resampling from fs to target_fs, no-op if the rates match. """
+    if fs == target_fs:
+        return x
+    ratio = Fraction(int(target_fs), int(fs))
+    return resample_poly(x, ratio.numerator, ratio.denominator).astype(np.float32)
+
+
+class PCMCache:
+    """ Disk cache of decoded and resampled PCM, read back through np.memmap.
+        Entries are keyed by absolute path, size, mtime and target rate, so a
+        modified wav is decoded again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, path, fs):
+        st = os.stat(path)
+        key = '{}|{}|{}|{}'.format(os.path.abspath(path), st.st_size, st.st_mtime, fs)
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.f32')
+
+    def get(self, path, fs):
+        cached = self._path(path, fs)
+        if not os.path.exists(cached):
+            return None
+        if os.path.getsize(cached) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return np.memmap(cached, dtype=np.float32, mode='r')
+
+    def put(self, path, fs, x):
+        cached = self._path(path, fs)
+        tmp = '{}.{}.tmp'.format(cached, os.getpid())
+        np.asarray(x, dtype=np.float32).tofile(tmp)
+        os.replace(tmp, cached)
+
+
+def load_audio(path, fs, cache=None):
+    """ Loads a file as mono float32 at rate fs, using the PCM cache if given. """
+    if cache is not None:
+        x = cache.get(path, fs)
+        if x is not None:
+            return x
+    x, native_fs = read_audio(path)
+    x = resample(x, native_fs, fs)
+    if cache is not None:
+        cache.put(path, fs, x)
+    return x
+
+
+def audio_info(path):
+    """ Returns (samples, sample rate) of a file without decoding it. """
+    if soundfile is not None:
+        info = soundfile.info(path)
+        return info.frames, info.samplerate
+    x, fs = read_audio(path)
+    return len(x), fs
+
+
+def stream_audio(path, blocksize=2 ** 18):
+    """ Yields mono float32 blocks of a file at its native rate.
+        Without soundfile the whole file is decoded and then split.
+    """
+    if soundfile is not None:
+        with soundfile.SoundFile(path) as f:
+            while True:
+                block = f.read(blocksize, dtype='float32', always_2d=True)
+                if len(block) == 0:
+                    break
+                yield block.mean(axis=1) if block.shape[1] > 1 else block[:, 0]
+    else:
+        x, fs = read_audio(path)
+        for n in range(0, len(x), blocksize):
+            yield x[n:n + blocksize]
+
+
+def stream_resample(blocks, fs, target_fs):
+    """ Polyphase resampling of a stream of blocks.
+        Segments start at multiples of the decimation factor and carry enough
+        input context for the resample_poly filter, so the concatenated output
+        equals resample(whole signal) up to float rounding.
+    """
+    if fs == target_fs:
+        for block in blocks:
+            yield block
+        return
+    ratio = Fraction(int(target_fs), int(fs))
+    up, down = ratio.numerator, ratio.denominator
+    half_len = 10 * max(up, down)
+    context = -(-(half_len // up + 2) // down) * down
+    buf = np.zeros(0, dtype=np.float32)
+    buf_start = 0
+    done = 0
+    for block in blocks:
+        buf = np.concatenate([buf, block])
+        end = (buf_start + len(buf) - context) // down * down
+        if end <= done:
+            continue
+        seg_start = max(0, done - context)
+        y = resample_poly(buf[seg_start - buf_start:end + context - buf_start], up, down)
+        skip = (done - seg_start) * up // down
+        yield y[skip:skip + (end - done) * up // down].astype(np.float32)
+        done = end
+        keep = max(0, done - context)
+        buf = buf[keep - buf_start:]
+        buf_start = keep
+    seg_start = max(0, done - context)
+    if buf_start + len(buf) > done:
+        y = resample_poly(buf[seg_start - buf_start:], up, down)
+        yield y[(done - seg_start) * up // down:].astype(np.float32)
@@ -0,0 +1,102 @@
+import numpy as np
+
+# Batch augmentation of (batch, frames, features, 1) spectrograms for the
+# data loaders, the random parameters of a whole batch are drawn at once and
+# applied in place with slice copies, instead of one ImageDataGenerator flow
+# per sample.
+
+
+class BatchAugmenter:
+    """ Random wrap shifts, SpecAugment style masks and mixup of the rows of a batch.
+        The shift ranges are fractions of the axis length as in
+        ImageDataGenerator (height = frames, width = features), shifts are
+        rounded to whole frames and bins.
+    """
+
+    def __init__(self, time_shift=0.9, freq_shift=0.05, time_masks=0, time_mask_width=50,
+                 freq_masks=0, freq_mask_width=20, mask_value=0.0, mixup_alpha=0.0):
+        """ Args:
+                time_shift (float): Shift range along the frames (height_shift_range).
+                freq_shift (float): Shift range along the features (width_shift_range).
+                time_masks, freq_masks (int): Number of masks per row on each axis.
+                time_mask_width, freq_mask_width (int): Maximum width of a mask.
+                mask_value (float): Value of the masked frames and bins.
+                mixup_alpha (float): Beta distribution parameter of mixup, 0 disables it.
+        """
+        self.time_shift = time_shift
+        self.freq_shift = freq_shift
+        self.time_masks = time_masks
+        self.time_mask_width = time_mask_width
+        self.freq_masks = freq_masks
+        self.freq_mask_width = freq_mask_width
+        self.mask_value = mask_value
+        self.mixup_alpha = mixup_alpha
+
+    def _shifts(self, rows, size, shift_range, rng):
+        if not shift_range:
+            return np.zeros(len(rows), dtype=np.int64)
+        return np.round(rng.uniform(-shift_range, shift_range, len(rows)) * size).astype(np.int64) % size
+
+    def _shift(self, x, rows, rng):
+        # wrap shift of both axes, four block copies per row
+        frames, bins = x.shape[1], x.shape[2]
+        time_shifts = self._shifts(rows, frames, self.time_shift, rng)
+        freq_shifts = self._shifts(rows, bins, self.freq_shift, rng)
+        for row, t, f in zip(rows, time_shifts, freq_shifts):
+            if t == 0 and f == 0:
+                continue
+            src = x[row].copy()
+            x[row, t:, f:] = src[:frames - t, :bins - f]
+            x[row, t:, :f] = src[:frames - t, bins - f:]
+            x[row, :t, f:] = src[frames - t:, :bins - f]
+            x[row, :t, :f] = src[frames - t:, bins - f:]
+
+    def _mask(self, x, rows, axis, count, width, rng):
+        size = x.shape[axis]
+        width = min(width, size)
+        widths = rng.randint(0, width + 1, (count, len(rows)))
+        starts = rng.randint(0, size - widths + 1)
+        for n, row in enumerate(rows):
+            for start, end in zip(starts[:, n], starts[:, n] + widths[:, n]):
+                if axis == 1:
+                    x[row, start:end] = self.mask_value
+                else:
+                    x[row, :, start:end] = self.mask_value
+
+    def augment(self, x, y=None, rows=None, rng=None, weights=None):
+        """ Augments rows of a batch in place.
+            Args:
+                x (ndarray): Batch (batch, frames, features, channels).
+                y (ndarray): Labels (batch, outputs), mixed with mixup.
+                rows (array): Indices of the rows to augment, all by default.
+                rng (RandomState): Source of the random parameters, seeded by the caller.
+                weights (ndarray): Per-sample loss weights (batch,), mixed as the labels.
+        """
+        rows = np.arange(len(x)) if rows is None else np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return x, y
+        rng = rng if rng is not None else np.random
+        if self.time_shift or self.freq_shift:
+            self._shift(x, rows, rng)
+        if self.time_masks:
+            self._mask(x, rows, 1, self.time_masks, self.time_mask_width, rng)
+        if self.freq_masks:
+            self._mask(x, rows, 2, self.freq_masks, self.freq_mask_width, rng)
+        if self.mixup_alpha > 0 and len(x) > 1:
+            # partners drawn from the whole batch, never the row itself: each
+            # row of a random cycle over the batch is mixed with the next one
+            lam = rng.beta(self.mixup_alpha, self.mixup_alpha, len(rows))
+            cycle = rng.permutation(len(x))
+            following = np.empty(len(x), dtype=np.int64)
+            following[cycle] = np.roll(cycle, -1)
+            partners = following[rows]
+            x_partners = x[partners]
+            lam_x = lam.reshape(-1, 1, 1, 1).astype(x.dtype)
+            x[rows] = lam_x * x[rows] + (1 - lam_x) * x_partners
+            if y is not None:
+                y_partners = y[partners]
+                y[rows] = lam[:, None] * y[rows] + (1 - lam[:, None]) * y_partners
+            if weights is not None:
+                w_partners = weights[partners]
+                weights[rows] = lam * weights[rows] + (1 - lam) * w_partners
+        return x, y
@@ -0,0 +1,73 @@
+import time
+import argparse
+import numpy as np
+from sklearn.metrics import roc_auc_score
+from frozen_model import load_model
+from data_loader import DataLoader, FeatureReader, read_filelist, read_labels
+from feature_store import load_stats
+
+# Latency, throughput and AUC of exported models (export.py) against the
+# Keras model they come from, on the clips of a filelist
+
+
+def timeit(function, repeat):
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser('Exported model benchmark')
+    parser.add_argument('model', help='Keras model (.h5)')
+    parser.add_argument('exported', nargs='+', help='Exported models (.npz)')
+    parser.add_argument('--weights', default=None, help='Weights loaded by name after the model')
+    parser.add_argument('--filelist', required=True, help='Filelist of labelled clips')
+    parser.add_argument('--spect-path', default='', help='Root of the feature files')
+    parser.add_argument('--features', default='npy', choices=['npy', 'npz', 'shard', 'mfc', 'h5'])
+    parser.add_argument('--labels', default='labels/', help='Directory of the label CSVs')
+    parser.add_argument('--datasets', nargs='+',
+                        default=['BirdVox-DCASE-20k.csv', 'ff1010bird.csv', 'warblrb10k.csv'])
+    parser.add_argument('--max-value', type=float, default=0)
+    parser.add_argument('--min-value', type=float, default=0)
+    parser.add_argument('--norm-stats', nargs='*', default=None,
+                        help='Statistics files for the global/bin normalization')
+    parser.add_argument('--norm-mode', default='none', choices=['none', 'global', 'bin'])
+    parser.add_argument('--norm-method', default='minmax', choices=['minmax', 'standard'])
+    parser.add_argument('--clips', type=int, default=512, help='Clips scored for the AUC')
+    parser.add_argument('--batch-size', type=int, default=32, help='Batch of the throughput test')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions, median time is reported')
+    args = parser.parse_args()
+
+    models = [('keras', load_model(args.model, args.weights))]
+    models += [(path, load_model(path)) for path in args.exported]
+    _, frames, n_features, _ = models[0][1].input_shape
+
+    file_ids = read_filelist(args.filelist)[:args.clips]
+    labels = read_labels(args.labels, args.datasets)
+    # labelled (train/val) filelist ids, 'mfc' files replace 4 characters
+    loader = DataLoader(file_ids, FeatureReader(args.spect_path, args.features, args.max_value, args.min_value),
+                        'test', len(file_ids), expected_shape=(frames or 1000, n_features),
+                        feature_stats=load_stats(args.norm_stats) if args.norm_stats else None,
+                        norm_mode=args.norm_mode, norm_method=args.norm_method, mfc_suffix=4)
+    x = loader[0][0]
+    y = np.array([float(labels[file_id]) for file_id in file_ids])
+
+    reference = None
+    print('{:40s} {:>12s} {:>12s} {:>8s} {:>10s}'.format('model', 'ms / clip', 'clips / s', 'AUC', 'AUC drop'))
+    for name, model in models:
+        latency = timeit(lambda: model.predict_on_batch(x[:1]), args.repeat)
+        batch = timeit(lambda: model.predict_on_batch(x[:args.batch_size]), args.repeat)
+        scores = np.concatenate([np.asarray(model.predict_on_batch(x[n:n + args.batch_size])).reshape(-1)
+                                 for n in range(0, len(x), args.batch_size)])
+        auc = roc_auc_score(y, scores) if len(np.unique(y)) > 1 else float('nan')
+        if reference is None:
+            reference = auc
+        print('{:40s} {:12.2f} {:12.1f} {:8.4f} {:10.4f}'.format(
+            name[-40:], latency * 1000, min(args.batch_size, len(x)) / batch, auc, reference - auc))
+
+
+if __name__ == '__main__':
+    main()
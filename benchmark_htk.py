@@ -0,0 +1,71 @@
+import os
+import time
+import struct
+import argparse
+import tempfile
+import numpy as np
+from HTK import HTKFile
+
+# Micro-benchmark of HTKFile.load against the original per-value struct loader
+
+
+def legacy_load(filename):
+    # Original float32 decoding loop of HTKFile.load, kept as reference
+    with open(filename, 'rb') as f:
+        nSamples, sampPeriod, sampSize, paramKind = struct.unpack('>iihh', f.read(12))
+        nFeatures = sampSize // 4
+        data = []
+        for x in range(nSamples):
+            s = f.read(sampSize)
+            frame = []
+            for v in range(nFeatures):
+                frame.append(struct.unpack_from('>f', s, v * 4)[0])
+            data.append(frame)
+    return np.array(data)
+
+
+def write_test_file(path, n_frames, n_features):
+    # MFCC (kind 6) float32 file with random content
+    data = np.random.randn(n_frames, n_features).astype('>f4')
+    with open(path, 'wb') as f:
+        f.write(struct.pack('>iihh', n_frames, 100000, n_features * 4, 6))
+        data.tofile(f)
+    return data
+
+
+def timeit(function, repeat):
+    best = float('inf')
+    for n in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser('HTKFile.load benchmark')
+    parser.add_argument('--frames', type=int, default=1000, help='Frames per file')
+    parser.add_argument('--features', type=int, default=180, help='Features per frame')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions, best time is reported')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.mfc')
+        reference = write_test_file(path, args.frames, args.features)
+
+        reader = HTKFile()
+        assert np.array_equal(reader.load(path), reference)
+        assert np.array_equal(legacy_load(path), reference)
+
+        t_legacy = timeit(lambda: legacy_load(path), args.repeat)
+        t_load = timeit(lambda: HTKFile().load(path), args.repeat)
+        t_mmap = timeit(lambda: HTKFile().load(path, mmap=True), args.repeat)
+
+    print('File: {} frames x {} features'.format(args.frames, args.features))
+    print('Legacy loop: {:.3f} ms'.format(t_legacy * 1000))
+    print('Vectorized:  {:.3f} ms ({:.0f}x)'.format(t_load * 1000, t_legacy / t_load))
+    print('Memmap open: {:.3f} ms'.format(t_mmap * 1000))
+
+
+if __name__ == '__main__':
+    main()
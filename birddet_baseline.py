@@ -1,30 +1,21 @@
-import h5py
 import csv
-import numpy as np
-import random
-import PIL.Image
 import logging
-#import matplotlib.pyplot as plt
-from HTK import HTKFile
-
-from sklearn.metrics import roc_auc_score, roc_curve, auc
+from feature_store import load_stats
+from data_loader import DataLoader, BucketLoader, FeatureReader, Prefetcher
+from catalog import open_catalog
+from online_features import OnlineFeatures, LRUCache
+from tensor_cache import TensorCache
+from augment import BatchAugmenter
 
 import keras
-from keras.layers import (Conv2D, Dropout, MaxPooling2D, Dense,
-                          GlobalAveragePooling2D, Flatten,
-                          BatchNormalization, AveragePooling2D)
-from keras.models import Sequential, load_model
-from keras.layers.advanced_activations import LeakyReLU
-from keras.preprocessing.image import ImageDataGenerator
-from keras.losses import (binary_crossentropy, mean_squared_error,
-                          mean_absolute_error)
-from keras.regularizers import l2
+from keras.models import load_model
+from architectures import build_model
 
 import my_callbacks
 from keras.callbacks import ModelCheckpoint
 from keras.callbacks import ReduceLROnPlateau
 from keras.callbacks import CSVLogger
-from keras.callbacks import EarlyStopping
+from keras.callbacks import LambdaCallback
 
 
 # Logging Config
@@ -47,8 +38,11 @@ logger.info('---------------------------- Program ---------------------------')
 logger.info('Reading all parameters')
 
 SPECTPATH = 'workingfiles/features_high_temporal/20_10_180_norm/'
+WAVPATH = 'workingfiles/wav/'
 LABELPATH = 'labels/'
 FILELIST = 'workingfiles/filelists/'
+# Labels, frame counts and filelists, rebuilt when a filelist or label CSV changes
+CATALOG = 'workingfiles/catalog.npz'
 
 RESULTPATH = 'trained_model/baseline/'
 SUBMISSIONFILE = 'predictions_TL_WF_B.csv'
@@ -64,23 +58,78 @@ BATCH_SIZE = 16
 EPOCH_SIZE = 30
 AUGMENT_SIZE = 1
 with_augmentation = False
-# features type : 'npy', 'mfc', 'h5'
+# Augmented copies: wrap shifts (fractions of frames / bins), SpecAugment
+# masks (count and maximum width) and mixup (Beta alpha, 0 disables it)
+TIME_SHIFT = 0.9
+FREQ_SHIFT = 0.05
+TIME_MASKS = 0
+TIME_MASK_WIDTH = 50
+FREQ_MASKS = 0
+FREQ_MASK_WIDTH = 20
+MIXUP_ALPHA = 0.0
+# Data loader processes, the 'wav' features already use WAV_WORKERS processes
+# so use_multiprocessing is turned off with them (USE_MULTIPROCESSING below)
+WORKERS = 4
+# Prefetching pipeline instead of the keras workers: filling threads, batches
+# prepared ahead and batch dtype ('float32' or 'float16')
+PREFETCH = True
+PREFETCH_WORKERS = 4
+PREFETCH_DEPTH = 4
+BATCH_DTYPE = 'float32'
+# Seed of the per-epoch shuffling and augmentation
+SEED = 0
+# features type : 'npy', 'npz' (quantized), 'shard' (preprocess_signal.py --shards), 'mfc', 'h5',
+#                 'wav' (computed from WAVPATH while training)
 features='npy'
+USE_MULTIPROCESSING = features != 'wav'
+# On-the-fly features: define_param process, spectrogram type, normalization,
+# background workers and LRU cache sizes (bytes), WAV_CACHE_DIR spills to disk
+WAV_PROCESS = 'frequential'
+WAV_TYPE = 'mel'
+WAV_NORM = 'individual'
+WAV_WORKERS = 4
+WAV_CACHE_RAM = 2 * 1024 ** 3
+WAV_CACHE_DIR = None
+WAV_CACHE_DISK = 20 * 1024 ** 3
+# Finished input tensors kept across epochs and shared by the train, validation
+# and test loaders: RAM budget (bytes, 0 disables it), memmap spill file and
+# its size, stored dtype. The loaders then run on threads (no multiprocessing).
+# Off by default; 'float16' halves the memory but rounds the training inputs
+TENSOR_CACHE_RAM = 0
+TENSOR_CACHE_SPILL = None
+TENSOR_CACHE_SPILL_SIZE = 16 * 1024 ** 3
+TENSOR_CACHE_DTYPE = 'float32'
 model_operation = 'load'
 # model_operations : 'new', 'load', 'test'
+# Architecture of new models, see architectures.py and profile_models.py
+# ARCHITECTURE : 'baseline', 'strided', 'separable', 'global_pool'
+ARCHITECTURE = 'baseline'
 shape = (1000, 180)
 expected_shape = (1000, 180)
 input_cnn_shape = (1000, 180, 1)
-spect = np.zeros(shape)
-label = np.zeros(1)
+# Variable length: clips batched by length buckets (frame counts from the
+# catalog) and a global pooling head instead of Flatten, for new models
+VARIABLE_LENGTH = False
+BUCKET_WIDTH = 100
+MIN_FRAMES = 200
+MAX_FRAMES = 3000
+if VARIABLE_LENGTH:
+    input_cnn_shape = (None, 180, 1)
 # Normalization
 max_value = 0
 min_value = 0
+# Statistics files from preprocess_signal.py --norm full, relative to SPECTPATH
+# NORM_MODE : 'none', 'global', 'bin' -- NORM_METHOD : 'minmax', 'standard'
+NORM_MODE = 'none'
+NORM_METHOD = 'minmax'
+NORM_STATS = ['BirdVox-DCASE-20k/stats.npz', 'ff1010bird/stats.npz',
+              'warblrb10k/stats.npz']
 
 # Callbacks for logging during epochs
 reduceLR = ReduceLROnPlateau(factor=0.2, patience=5, min_lr=0.00001)
+# val_auc comes from my_callbacks.ValidationMetrics, first in the callback list
 checkPoint = ModelCheckpoint(filepath = checkpoint_model_name,
-                             monitor= 'val_acc', mode = 'max',
+                             monitor= 'val_auc', mode = 'max',
                              save_best_only=True)
 csvLogger = CSVLogger(logfile_name, separator=',', append=False)
 
@@ -97,380 +146,102 @@ logger.info('Data set selection')
 k_VAL_FILE = 'validation_file_path'
 k_TEST_FILE = 'test_file_path'
 k_TRAIN_FILE = 'train_file_path'
-k_VAL_SIZE = 'validate_size'
-k_TEST_SIZE = 'test_size'
-k_TRAIN_SIZE = 'train_size'
 k_CLASS_WEIGHT = 'class_weight'
 
 # Declare the dictionaries to represent the data sets
 d_birdVox = {k_VAL_FILE: 'val_B', k_TEST_FILE: 'test_B', k_TRAIN_FILE: 'train_B',
-             k_VAL_SIZE: 1000.0, k_TEST_SIZE: 3000.0, k_TRAIN_SIZE: 16000.0,
              k_CLASS_WEIGHT: {0: 0.50,1: 0.50}}
 d_warblr = {k_VAL_FILE: 'val_W', k_TEST_FILE: 'test_W', k_TRAIN_FILE: 'train_W',
-            k_VAL_SIZE: 400.0, k_TEST_SIZE: 1200.0, k_TRAIN_SIZE: 6400.0,
             k_CLASS_WEIGHT: {0: 0.75, 1: 0.25}}
 d_freefield = {k_VAL_FILE: 'val_F', k_TEST_FILE: 'test_F', k_TRAIN_FILE: 'train_F',
-               k_VAL_SIZE: 385.0, k_TEST_SIZE: 1153.0, k_TRAIN_SIZE: 6152.0,
                k_CLASS_WEIGHT: {0: 0.25, 1: 0.75}}
 d_fold1 = {k_VAL_FILE: 'val_WF', k_TEST_FILE: 'test_WF', k_TRAIN_FILE: 'train_WF',
-           k_VAL_SIZE: 785.0, k_TEST_SIZE: 2353.0, k_TRAIN_SIZE: 12552.0,
            k_CLASS_WEIGHT: {0: 0.50, 1: 0.50}}
 d_all3 = {k_VAL_FILE: 'val_BWF_short', k_TEST_FILE:'test', k_TRAIN_FILE: 'train_BWF_short',
-           k_VAL_SIZE: 1000.0, k_TEST_SIZE: 12620.0, k_TRAIN_SIZE: 16000.0,
            k_CLASS_WEIGHT: {0: 0.50, 1: 0.50}}
 d_test = {k_VAL_FILE: 'val_test', k_TEST_FILE:'test_test', k_TRAIN_FILE: 'train_test',
-           k_VAL_SIZE: 20.0, k_TEST_SIZE: 20.0, k_TRAIN_SIZE: 45.0,
            k_CLASS_WEIGHT: {0: 0.50, 1: 0.50}}
 # Set these variables to change the data set.
 training_set = d_birdVox
 validation_set = d_birdVox
 test_set = d_birdVox
 
+# Features computed from the wavs on background workers, cached across epochs
+online_features = None
+if features == 'wav':
+    online_features = OnlineFeatures(WAVPATH, WAV_PROCESS, WAV_TYPE, WAV_NORM,
+                                     WAV_WORKERS, LRUCache(WAV_CACHE_RAM, WAV_CACHE_DIR, WAV_CACHE_DISK))
+
+# Global statistics for the 'full' normalization, applied to whole batches
+feature_stats = None
+if NORM_MODE != 'none':
+    feature_stats = load_stats([SPECTPATH + p for p in NORM_STATS])
+
 logger.info(f"Dataset -- Training: {training_set}, Validation:"
             "{validation_set}, Test: {test_set}")
 
-# Grab the file lists and sizes from the corresponding data sets.
-train_filelist = FILELIST + training_set[k_TRAIN_FILE]
-TRAIN_SIZE = training_set[k_TRAIN_SIZE]
+# Grab the file lists and sizes from the catalog
+catalog = open_catalog(CATALOG, LABELPATH, dataset, FILELIST,
+                       [training_set[k_TRAIN_FILE], validation_set[k_VAL_FILE], test_set[k_TEST_FILE]],
+                       SPECTPATH if features in ('npy', 'npz', 'shard', 'mfc', 'h5') else None, features)
+train_items = catalog.split(training_set[k_TRAIN_FILE])
+TRAIN_SIZE = len(train_items)
 
-val_filelist = FILELIST + validation_set[k_VAL_FILE]
-VAL_SIZE = validation_set[k_VAL_SIZE]
+val_items = catalog.split(validation_set[k_VAL_FILE])
+VAL_SIZE = len(val_items)
 
-test_filelist = FILELIST + test_set[k_TEST_FILE]
-TEST_SIZE = test_set[k_TEST_SIZE]
+test_items = catalog.split(test_set[k_TEST_FILE])
+TEST_SIZE = len(test_items)
+logger.info(f"Items -- Training: {TRAIN_SIZE}, Validation: {VAL_SIZE}, Test: {TEST_SIZE}")
 
 ################################################
 #
-#   Generator with Augmentation
+#   Data loaders
 #
 ################################################
 
-# use this generator when augmentation is needed
-def data_generator(filelistpath, batch_size=16, shuffle=False):
-    batch_index = 0
-    image_index = -1
-    filelist = open(filelistpath, 'r')
-    filenames = filelist.readlines()
-    filelist.close()
-
-    # shuffling filelist
-    if shuffle==True:
-        random.shuffle(filenames)
-
-    # read labels and save in a dict
-    labels_dict = {}
-    for n in range(len(dataset)):
-        labels_list = csv.reader(open(LABELPATH + dataset[n], 'r'))
-        next(labels_list)
-        for k, r, v in labels_list:
-            labels_dict[r + '/' + k + '.wav'] = v
-
-    while True:
-        image_index = (image_index + 1) % len(filenames)
-
-        # if shuffle and image_index = 0
-        # shuffling filelist
-        if shuffle == True and image_index == 0:
-            random.shuffle(filenames)
-
-        file_id = filenames[image_index].rstrip()
-
-        if batch_index == 0:
-            # re-initialize spectrogram and label batch
-            spect_batch = np.zeros([1, spect.shape[0], spect.shape[1], 1])
-            label_batch = np.zeros([1, 1])
-            aug_spect_batch = np.zeros([batch_size, spect.shape[0], spect.shape[1], 1])
-            aug_label_batch = np.zeros([batch_size, 1])
-
-        # load features with the select format
-        if features=='h5':
-            hf = h5py.File(SPECTPATH + file_id + '.h5', 'r')
-            imagedata = hf.get('features')
-            imagedata = np.array(imagedata)
-            hf.close()
-            imagedata = (imagedata + 15.0966)/(15.0966 + 2.25745)
-        elif features == 'npy':
-            imagedata = np.load(SPECTPATH + file_id + '.npy')
-            if max_value != 0 and min_value != 0:
-                imagedata = (imagedata - min_value)/(max_value - min_value)
-        elif features == 'mfc':
-            htk_reader = HTKFile()
-            htk_reader.load(SPECTPATH + file_id[:-4] + '.mfc')
-            imagedata = np.array(htk_reader.data)
-            imagedata = imagedata / 17.0
-
-        # processing files with shapes other than expected shape in warblr dataset
-
-        if imagedata.shape[0] != expected_shape[0]:
-            old_imagedata = imagedata
-            imagedata = np.zeros(expected_shape)
-
-            if old_imagedata.shape[0] < expected_shape[0]:
-
-                diff_in_frames = expected_shape[0] - old_imagedata.shape[0]
-                if diff_in_frames < expected_shape[0] / 2:
-                    imagedata = np.vstack((old_imagedata, old_imagedata[
-                        range(old_imagedata.shape[0] - diff_in_frames, old_imagedata.shape[0])]))
-
-                elif diff_in_frames > expected_shape[0] / 2:
-                    count = np.floor(expected_shape[0] / old_imagedata.shape[0])
-                    remaining_diff = (expected_shape[0] - old_imagedata.shape[0] * int(count))
-                    imagedata = np.vstack(([old_imagedata] * int(count)))
-                    imagedata = np.vstack(
-                        (imagedata, old_imagedata[range(old_imagedata.shape[0] - remaining_diff, old_imagedata.shape[0])]))
-
-            elif old_imagedata.shape[0] > expected_shape[0]:
-                diff_in_frames = old_imagedata.shape[0] - expected_shape[0]
-
-                if diff_in_frames < expected_shape[0] / 2:
-                    imagedata[range(0, diff_in_frames + 1), :] = np.mean(np.array([old_imagedata[range(0, diff_in_frames + 1), :],old_imagedata[range(old_imagedata.shape[0] - diff_in_frames - 1, old_imagedata.shape[0]), :]]),axis=0)
-                    imagedata[range(diff_in_frames + 1, expected_shape[0]), :] = old_imagedata[range(diff_in_frames + 1, expected_shape[0])]
-
-                elif diff_in_frames > expected_shape[0] / 2:
-                    count = int(np.floor(old_imagedata.shape[0] / expected_shape[0]))
-                    remaining_diff = (old_imagedata.shape[0] - expected_shape[0] * count)
-                    for index in range(0, count):
-                        imagedata[range(0, expected_shape[0]), :] = np.sum([imagedata, old_imagedata[range(index * expected_shape[0], (index + 1) * expected_shape[0])]],axis=0) / count
-                        imagedata[range(0, remaining_diff), :] = np.mean(np.array([old_imagedata[range(old_imagedata.shape[0] - remaining_diff, old_imagedata.shape[0]), :],imagedata[range(0, remaining_diff), :]]), axis=0)
-
-
-        imagedata = np.reshape(imagedata, (1, imagedata.shape[0], imagedata.shape[1], 1))
-
-        spect_batch[0, :, :, :] = imagedata
-        label_batch[0, :] = labels_dict[file_id]
-
-        gen_img = datagen.flow(imagedata, label_batch[0, :], batch_size=1, shuffle=False, save_to_dir=None)
-        aug_spect_batch[batch_index, :, :, :] = imagedata
-        aug_label_batch[batch_index, :] = label_batch[0, :]
-        batch_index += 1
-
-        # create the batch with the features and the labels
-        for n in range(AUGMENT_SIZE-1):
-            aug_spect_batch[batch_index, :, :, :], aug_label_batch[batch_index, :] = gen_img.next()
-            batch_index += 1
-            if batch_index >= batch_size:
-                batch_index = 0
-                inputs = [aug_spect_batch]
-                outputs = [aug_label_batch]
-                yield inputs, outputs
-
-
-################################################
-#
-#   Generator without Augmentation
-#
-################################################
-
-def dataval_generator(filelistpath, batch_size=32, shuffle=False):
-    batch_index = 0
-    image_index = -1
-
-    filelist = open(filelistpath, 'r')
-    filenames = filelist.readlines()
-    filelist.close()
-
-
-    # read labels and save in a dict
-    labels_dict = {}
-    labels_dict = {}
-    for n in range(len(dataset)):
-        labels_list = csv.reader(open(LABELPATH + dataset[n], 'r'))
-        next(labels_list)
-        for k, r, v in labels_list:
-            labels_dict[r + '/' + k + '.wav'] = v
-
-    while True:
-        image_index = (image_index + 1) % len(filenames)
-
-        # if shuffle and image_index = 0
-        # shuffling filelist
-        if shuffle == True and image_index == 0:
-            random.shuffle(filenames)
-
-        file_id = filenames[image_index].rstrip()
-
-        if batch_index == 0:
-            # re-initialize spectrogram and label batch
-            spect_batch = np.zeros([batch_size, spect.shape[0], spect.shape[1], 1])
-            label_batch = np.zeros([batch_size, 1])
-
-        # load features with the select format
-        if features == 'h5':
-            hf = h5py.File(SPECTPATH + file_id + '.h5', 'r')#[:-4]for evaluation dataset
-            imagedata = hf.get('features')
-            imagedata = np.array(imagedata)
-            hf.close()
-            imagedata = (imagedata + 15.0966)/(15.0966 + 2.25745)
-        elif features == 'npy':
-            imagedata = np.load(SPECTPATH + file_id + '.npy')
-            if max_value != 0 and min_value != 0:
-                imagedata = (imagedata - min_value)/(max_value - min_value)
-        elif features == 'mfc':
-            htk_reader = HTKFile()
-            htk_reader.load(SPECTPATH + file_id[:-4] + '.mfc')
-            imagedata = np.array(htk_reader.data)
-            imagedata = imagedata/17.0
-
-        # processing files with shapes other than expected shape in warblr dataset
-        if imagedata.shape[0] != expected_shape[0]:
-            old_imagedata = imagedata
-            imagedata = np.zeros(expected_shape)
-
-            if old_imagedata.shape[0] < expected_shape[0]:
-
-                diff_in_frames = expected_shape[0] - old_imagedata.shape[0]
-                if diff_in_frames < expected_shape[0] / 2:
-                    imagedata = np.vstack((old_imagedata, old_imagedata[
-                        range(old_imagedata.shape[0] - diff_in_frames, old_imagedata.shape[0])]))
-
-                elif diff_in_frames > expected_shape[0] / 2:
-                    count = np.floor(expected_shape[0] / old_imagedata.shape[0])
-                    remaining_diff = (expected_shape[0] - old_imagedata.shape[0] * int(count))
-                    imagedata = np.vstack(([old_imagedata] * int(count)))
-                    imagedata = np.vstack(
-                        (imagedata, old_imagedata[range(old_imagedata.shape[0] - remaining_diff, old_imagedata.shape[0])]))
-
-            elif old_imagedata.shape[0] > expected_shape[0]:
-                diff_in_frames = old_imagedata.shape[0] - expected_shape[0]
-
-                if diff_in_frames < expected_shape[0] / 2:
-                    imagedata[range(0, diff_in_frames + 1), :] = np.mean(np.array([old_imagedata[range(0, diff_in_frames + 1), :],old_imagedata[range(old_imagedata.shape[0] - diff_in_frames - 1, old_imagedata.shape[0]), :]]),axis=0)
-                    imagedata[range(diff_in_frames + 1, expected_shape[0]), :] = old_imagedata[range(diff_in_frames + 1, expected_shape[0])]
-
-                elif diff_in_frames > expected_shape[0] / 2:
-                    count = int(np.floor(old_imagedata.shape[0] / expected_shape[0]))
-                    remaining_diff = (old_imagedata.shape[0] - expected_shape[0] * count)
-                    for index in range(0, count):
-                        imagedata[range(0, expected_shape[0]), :] = np.sum([imagedata, old_imagedata[range(index * expected_shape[0], (index + 1) * expected_shape[0])]],axis=0) / count
-                        imagedata[range(0, remaining_diff), :] = np.mean(np.array([old_imagedata[range(old_imagedata.shape[0] - remaining_diff, old_imagedata.shape[0]), :],imagedata[range(0, remaining_diff), :]]), axis=0)
-
-        imagedata = np.reshape(imagedata, (1, imagedata.shape[0], imagedata.shape[1], 1))
-        spect_batch[batch_index, :, :, :] = imagedata
-        if model_operation != 'test':
-            label_batch[batch_index, :] = labels_dict[file_id]
-
-        batch_index += 1
-
-        # create the batch with the features and the labels
-        if batch_index >= batch_size:
-            batch_index = 0
-            inputs = [spect_batch]
-            outputs = [label_batch]
-            yield inputs, outputs
-
-def datatest_generator(filelistpath, batch_size=32, shuffle=False):
-    batch_index = 0
-    image_index = -1
-
-    filelist = open(filelistpath, 'r')
-    filenames = filelist.readlines()
-    filelist.close()
-
-    # read labels and save in a dict
-    labels_dict = {}
-    labels_dict = {}
-    for n in range(len(dataset)):
-        labels_list = csv.reader(open(LABELPATH + dataset[n], 'r'))
-        next(labels_list)
-        for k, r, v in labels_list:
-            labels_dict[r + '/' + k] = v
-
-    while True:
-        image_index = (image_index + 1) % len(filenames)
-
-        # if shuffle and image_index = 0
-        # shuffling filelist
-        if shuffle == True and image_index == 0:
-            random.shuffle(filenames)
-
-        file_id = filenames[image_index].rstrip()
-
-        if batch_index == 0:
-            # re-initialize spectrogram and label batch
-            spect_batch = np.zeros([batch_size, spect.shape[0], spect.shape[1], 1])
-            label_batch = np.zeros([batch_size, 1])
-
-        # load features with the select format
-        if features == 'h5':
-            hf = h5py.File(SPECTPATH + file_id + '.h5', 'r')#[:-4]for evaluation dataset
-            imagedata = hf.get('features')
-            imagedata = np.array(imagedata)
-            hf.close()
-            imagedata = (imagedata + 15.0966)/(15.0966 + 2.25745)
-        elif features == 'npy':
-            imagedata = np.load(SPECTPATH + file_id + '.npy')
-            if max_value != 0 and min_value != 0:
-                imagedata = (imagedata - min_value)/(max_value - min_value)
-        elif features == 'mfc':
-            htk_reader = HTKFile()
-            htk_reader.load(SPECTPATH + file_id[:-8] + '.mfc')
-            imagedata = np.array(htk_reader.data)
-            imagedata = imagedata/17.0
-
-        # processing files with shapes other than expected shape in warblr dataset
-        if imagedata.shape[0] != expected_shape[0]:
-            old_imagedata = imagedata
-            imagedata = np.zeros(expected_shape)
-
-            if old_imagedata.shape[0] < expected_shape[0]:
-
-                diff_in_frames = expected_shape[0] - old_imagedata.shape[0]
-                if diff_in_frames < expected_shape[0] / 2:
-                    imagedata = np.vstack((old_imagedata, old_imagedata[
-                        range(old_imagedata.shape[0] - diff_in_frames, old_imagedata.shape[0])]))
-
-                elif diff_in_frames > expected_shape[0] / 2:
-                    count = np.floor(expected_shape[0] / old_imagedata.shape[0])
-                    remaining_diff = (expected_shape[0] - old_imagedata.shape[0] * int(count))
-                    imagedata = np.vstack(([old_imagedata] * int(count)))
-                    imagedata = np.vstack(
-                        (imagedata, old_imagedata[range(old_imagedata.shape[0] - remaining_diff, old_imagedata.shape[0])]))
-
-            elif old_imagedata.shape[0] > expected_shape[0]:
-                diff_in_frames = old_imagedata.shape[0] - expected_shape[0]
-
-                if diff_in_frames < expected_shape[0] / 2:
-                    imagedata[range(0, diff_in_frames + 1), :] = np.mean(np.array([old_imagedata[range(0, diff_in_frames + 1), :],old_imagedata[range(old_imagedata.shape[0] - diff_in_frames - 1, old_imagedata.shape[0]), :]]),axis=0)
-                    imagedata[range(diff_in_frames + 1, expected_shape[0]), :] = old_imagedata[range(diff_in_frames + 1, expected_shape[0])]
-
-                elif diff_in_frames > expected_shape[0] / 2:
-                    count = int(np.floor(old_imagedata.shape[0] / expected_shape[0]))
-                    remaining_diff = (old_imagedata.shape[0] - expected_shape[0] * count)
-                    for index in range(0, count):
-                        imagedata[range(0, expected_shape[0]), :] = np.sum([imagedata, old_imagedata[range(index * expected_shape[0], (index + 1) * expected_shape[0])]],axis=0) / count
-                        imagedata[range(0, remaining_diff), :] = np.mean(np.array([old_imagedata[range(old_imagedata.shape[0] - remaining_diff, old_imagedata.shape[0]), :],imagedata[range(0, remaining_diff), :]]), axis=0)
-
-        imagedata = np.reshape(imagedata, (1, imagedata.shape[0], imagedata.shape[1], 1))
-
-        spect_batch[batch_index, :, :, :] = imagedata
-
-        batch_index += 1
-
-        # create the batch with the features
-        if batch_index >= batch_size:
-            batch_index = 0
-            inputs = [spect_batch]
-            yield inputs
-################################################
-
 logger.info('Genereting data for Tranning')
 
-if(with_augmentation == True):
-    train_generator = data_generator(train_filelist, BATCH_SIZE, True)
+datagen = BatchAugmenter(
+    time_shift=TIME_SHIFT,
+    freq_shift=FREQ_SHIFT,
+    time_masks=TIME_MASKS,
+    time_mask_width=TIME_MASK_WIDTH,
+    freq_masks=FREQ_MASKS,
+    freq_mask_width=FREQ_MASK_WIDTH,
+    mixup_alpha=MIXUP_ALPHA)
+
+# labels of the catalog in a dict
+labels_dict = catalog.labels()
+feature_reader = FeatureReader(SPECTPATH, features, max_value, min_value, online_features)
+
+tensor_cache = None
+if TENSOR_CACHE_RAM > 0:
+    tensor_cache = TensorCache(TENSOR_CACHE_RAM, TENSOR_CACHE_SPILL, TENSOR_CACHE_SPILL_SIZE, TENSOR_CACHE_DTYPE)
+    # worker processes would each fill their own copy of the cache
+    USE_MULTIPROCESSING = False
+
+loader_args = dict(expected_shape=expected_shape, feature_stats=feature_stats,
+                   norm_mode=NORM_MODE, norm_method=NORM_METHOD, tensor_cache=tensor_cache,
+                   dtype=BATCH_DTYPE)
+if VARIABLE_LENGTH:
+    bucket_args = dict(bucket_width=BUCKET_WIDTH, min_frames=MIN_FRAMES, max_frames=MAX_FRAMES)
+    train_loader = BucketLoader(train_items, feature_reader, catalog.frames(training_set[k_TRAIN_FILE]), 'train',
+                                BATCH_SIZE, shuffle=True, seed=SEED, labels=labels_dict,
+                                augmenter=datagen if with_augmentation else None, augment_size=AUGMENT_SIZE,
+                                class_weight=training_set[k_CLASS_WEIGHT], **dict(loader_args, **bucket_args))
+    validation_loader = BucketLoader(val_items, feature_reader, catalog.frames(validation_set[k_VAL_FILE]), 'val',
+                                     BATCH_SIZE, labels=labels_dict, **dict(loader_args, **bucket_args))
+    test_loader = BucketLoader(test_items, feature_reader, catalog.frames(test_set[k_TEST_FILE]), 'test',
+                               BATCH_SIZE, **dict(loader_args, **bucket_args))
 else:
-    train_generator = dataval_generator(train_filelist, BATCH_SIZE, True)
-
-validation_generator = dataval_generator(val_filelist, BATCH_SIZE, False)
-test_generator = datatest_generator(test_filelist, BATCH_SIZE, False)
-
-datagen = ImageDataGenerator(
-    featurewise_center=False,
-    featurewise_std_normalization=False,
-    rotation_range=0,
-    width_shift_range=0.05,
-    height_shift_range=0.9,
-    horizontal_flip=False,
-    fill_mode="wrap")
+    train_loader = DataLoader(train_items, feature_reader, 'train', BATCH_SIZE, shuffle=True, seed=SEED,
+                              labels=labels_dict, augmenter=datagen if with_augmentation else None,
+                              augment_size=AUGMENT_SIZE, class_weight=training_set[k_CLASS_WEIGHT],
+                              **loader_args)
+    validation_loader = DataLoader(val_items, feature_reader, 'val', BATCH_SIZE, labels=labels_dict,
+                                   **loader_args)
+    test_loader = DataLoader(test_items, feature_reader, 'test', BATCH_SIZE, **loader_args)
 
 ################################################
 #
@@ -478,39 +249,9 @@ datagen = ImageDataGenerator(
 #
 ################################################
 if model_operation == 'new':
-    logger.info('Creating new Sequential Mode')
-    model = Sequential()
-
-    # convolution layers
-    model.add(Conv2D(16, (3, 3), padding='valid', input_shape=input_cnn_shape, ))  # low: try different kernel_initializer
-    model.add(BatchNormalization())  # explore order of Batchnorm and activation
-    model.add(LeakyReLU(alpha=.001))
-    model.add(MaxPooling2D(pool_size=(3, 3)))  # experiment with using smaller pooling along frequency axis
-    model.add(Conv2D(16, (3, 3), padding='valid'))
-    model.add(BatchNormalization())
-    model.add(LeakyReLU(alpha=.001))
-    model.add(MaxPooling2D(pool_size=(3, 3)))
-    model.add(Conv2D(16, (3, 3), padding='valid'))
-    model.add(BatchNormalization())
-    model.add(LeakyReLU(alpha=.001))
-    model.add(MaxPooling2D(pool_size=(3, 1)))
-    model.add(Conv2D(16, (3, 3), padding='valid', kernel_regularizer=l2(0.01)))  # drfault 0.01. Try 0.001 and 0.001
-    model.add(BatchNormalization())
-    model.add(LeakyReLU(alpha=.001))
-    model.add(MaxPooling2D(pool_size=(3, 1)))
-
-    # dense layers
-    model.add(Flatten())
-    model.add(Dropout(0.5))
-    model.add(Dense(256))
-    model.add(BatchNormalization())
-    model.add(LeakyReLU(alpha=.001))
-    model.add(Dropout(0.5))
-    model.add(Dense(32))
-    model.add(BatchNormalization())
-    model.add(LeakyReLU(alpha=.001))  # leaky relu value is very small experiment with bigger ones
-    model.add(Dropout(0.5))  # experiment with removing this dropout
-    model.add(Dense(1, activation='sigmoid'))
+    logger.info('Creating new {} model'.format(ARCHITECTURE))
+    # variable length inputs need a global pooling head
+    model = build_model(ARCHITECTURE, input_cnn_shape, 'global' if VARIABLE_LENGTH else None)
 
 # load model and weights from other trainings
 elif model_operation == 'load' or model_operation == 'test':
@@ -522,45 +263,61 @@ if model_operation == 'new' or model_operation == 'load':
     adam = keras.optimizers.Adam(lr=0.001, beta_1=0.9, beta_2=0.999, epsilon=None, decay=0.0)
     model.compile(optimizer=adam, loss='binary_crossentropy', metrics=['acc'])
 
-    # prepare callback
-    histories = my_callbacks.Histories()
-
 model.summary()
 logger.info(model.summary())
 
-my_steps = np.floor(TRAIN_SIZE*AUGMENT_SIZE / BATCH_SIZE)
-my_val_steps = np.floor(VAL_SIZE / BATCH_SIZE)
-my_test_steps = np.ceil(TEST_SIZE / BATCH_SIZE)
+my_steps = len(train_loader)
+my_val_steps = len(validation_loader)
+my_test_steps = len(test_loader)
+
+callbacks = [checkPoint, reduceLR, csvLogger]
+train_data, validation_data, test_data = train_loader, validation_loader, test_loader
+if PREFETCH:
+    train_data = Prefetcher(train_loader, PREFETCH_WORKERS, PREFETCH_DEPTH)
+    validation_data = Prefetcher(validation_loader, PREFETCH_WORKERS, PREFETCH_DEPTH)
+    test_data = Prefetcher(test_loader, PREFETCH_WORKERS, PREFETCH_DEPTH)
+    # time the model waited for the input pipeline (I/O bound if it grows)
+    callbacks.append(LambdaCallback(on_epoch_end=lambda epoch, logs: logger.info(
+        'Epoch {} input: {}'.format(epoch + 1, train_data.report()))))
+    WORKERS = 0
+# streamed validation pass (loss, accuracy, overall and per dataset AUC),
+# instead of the one of fit_generator
+callbacks.insert(0, my_callbacks.ValidationMetrics(validation_loader, validation_data if PREFETCH else None))
 
 # fit the model and start training
 if model_operation == 'new' or model_operation == 'load':
     logger.info('Model fitting')
     history = model.fit_generator(
-        train_generator,
+        train_data,
         steps_per_epoch=my_steps,
         epochs=EPOCH_SIZE,
-        validation_data=validation_generator,
-        validation_steps=my_val_steps,
-        callbacks= [checkPoint, reduceLR, csvLogger],
-        class_weight= training_set[k_CLASS_WEIGHT],
+        callbacks=callbacks,
+        # class weights are per-sample weights of the train batches (mixup soft labels)
+        workers=WORKERS,
+        use_multiprocessing=USE_MULTIPROCESSING,
+        shuffle=False,
         verbose=True)
 
+    if tensor_cache is not None:
+        logger.info('Tensor cache: {} hits, {} misses'.format(tensor_cache.hits, tensor_cache.misses))
     model.save(final_model_name)
     model.save_weights(final_weights_name)
     logger.info('Training done. The results are in :\n'+RESULTPATH)
 
 # Generate the predicitons in the test step
 logger.info('Genereting Predictions')
-pred_generator = datatest_generator(test_filelist, BATCH_SIZE, False)
 y_pred = model.predict_generator(
-    pred_generator,
-    steps=my_test_steps)
+    test_data,
+    steps=my_test_steps,
+    workers=WORKERS,
+    use_multiprocessing=USE_MULTIPROCESSING)
+if VARIABLE_LENGTH:
+    # back from bucket order to filelist order
+    y_pred[test_loader.item_order()] = y_pred.copy()
 
 # saving predictions in csv file
 
-testfile = open(test_filelist, 'r')
-testfilenames = testfile.readlines()
-testfile.close()
+testfilenames = test_items
 
 HEADER = ['itemid','prediction']
 
@@ -570,6 +327,6 @@ try:
     writer.writerow(HEADER)
     for i in range(len(testfilenames)):
         strf = testfilenames[i]
-        writer.writerow((strf[strf.find('/')+1:-5], float(y_pred[i])))
+        writer.writerow((strf[strf.find('/')+1:-4], float(y_pred[i])))
 finally:
     fidwr.close()
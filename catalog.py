@@ -0,0 +1,314 @@
+import os
+import csv
+import logging
+import argparse
+import numpy as np
+from HTK import HTKFile
+from feature_store import ShardReader, SHARD_DIR, SHARD_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Dataset catalog: one binary file with every labelled or listed item and
+# the filelists it belongs to, built once from the label CSVs, filelists
+# and feature files, then loaded by birddet_baseline.py instead of parsing
+# the CSVs again.
+
+# ---- CATALOG FILE (.npz) ---- #
+#   items    : structured array, one row per item id (see ITEM_DTYPE)
+#   datasets : dataset names, items['dataset'] indexes this array
+#   split_<filelist> : rows of the items in a filelist, in filelist order
+#   mtime_<filelist> : modification time of the filelist when built
+#   labels_mtime : newest modification time of the label CSVs
+#   spect_path, features : feature files of the frame counts ('' if none)
+#   features_mtime : newest modification time of the feature directories
+#                    (shard indexes) when the frame counts were read
+ITEM_DTYPE = np.dtype([('item', 'S128'),     # '<datasetid>/<itemid>.wav'
+                       ('dataset', np.int16),
+                       ('label', np.int8),   # -1 if not in the label CSVs
+                       ('frames', np.int32),  # -1 if no feature file found
+                       ('shard', np.int16),   # shard store only, else -1
+                       ('offset', np.int64),  # frame offset in the shard
+                       ])
+SPLIT_PREFIX = 'split_'
+MTIME_PREFIX = 'mtime_'
+# ----------------------------- #
+
+
+def features_mtime(spect_path, features, directories):
+    """ Newest modification time of the feature directories of the items
+        (their shard index for 'shard'), it changes when a feature file is
+        added or removed. 0 if none exists.
+    """
+    mtime = 0.0
+    for directory in directories:
+        path = os.path.join(spect_path, directory)
+        if features == 'shard':
+            path = os.path.join(path, SHARD_DIR, SHARD_INDEX)
+        if os.path.exists(path):
+            mtime = max(mtime, os.path.getmtime(path))
+    return mtime
+
+
+def _feature_extent(spect_path, features, item, shards, suffix):
+    """ (frames, shard, offset) of the stored features of an item without
+        loading them, frames is -1 if the file is missing.
+    """
+    if features == 'shard':
+        directory, name = os.path.split(item)
+        if directory not in shards:
+            try:
+                shards[directory] = ShardReader(os.path.join(spect_path, directory))
+            except (IOError, OSError):
+                shards[directory] = None
+        reader = shards[directory]
+        if reader is None or name not in reader:
+            return -1, -1, -1
+        shard, offset, frames = reader.items[name]
+        return frames, shard, offset
+    try:
+        if features == 'npy':
+            return np.load(spect_path + item + '.npy', mmap_mode='r').shape[0], -1, -1
+        if features == 'npz':
+            with np.load(spect_path + item + '.npz') as stored:
+                return stored['q'].shape[0], -1, -1
+        if features == 'mfc':
+            htk_reader = HTKFile()
+            htk_reader.load(spect_path + item[:-suffix] + '.mfc', mmap=True)
+            return htk_reader.nSamples, -1, -1
+        if features == 'h5':
+            import h5py
+            with h5py.File(spect_path + item + '.h5', 'r') as hf:
+                return hf['features'].shape[0], -1, -1
+    except (IOError, OSError, KeyError):
+        pass
+    return -1, -1, -1
+
+
+class Catalog:
+    """ Items, labels, frame counts and filelist membership of the datasets. """
+
+    def __init__(self, items, datasets, splits, mtimes=None, labels_mtime=0,
+                 spect_path=None, features=None, features_mtime=0):
+        self.items = items
+        self.datasets = list(datasets)
+        self.splits = splits
+        self.mtimes = mtimes if mtimes is not None else {}
+        self.labels_mtime = labels_mtime
+        self.spect_path = spect_path
+        self.features = features
+        self.features_mtime = features_mtime
+
+    @classmethod
+    def build(cls, label_path, datasets, filelist_path=None, filelists=(),
+              spect_path=None, features='npy', suffix='.wav'):
+        """ Args:
+                label_path (string): Directory of the label CSVs (LABELPATH).
+                datasets (list): Label CSV names, as the dataset list of birddet_baseline.py.
+                filelist_path (string): Directory of the filelists (FILELIST).
+                filelists (list): Filelist names stored as splits.
+                spect_path (string): Root of the feature files for the frame counts, optional.
+                features (string): 'npy', 'npz', 'shard', 'mfc' or 'h5'.
+        """
+        names = []
+        rows = {}
+        labels_mtime = 0
+        records = []
+
+        def add(item, dataset, label):
+            if dataset not in names:
+                names.append(dataset)
+            rows[item] = len(records)
+            records.append([item, names.index(dataset), label])
+
+        for name in datasets:
+            labels_mtime = max(labels_mtime, os.path.getmtime(os.path.join(label_path, name)))
+            with open(os.path.join(label_path, name), 'r') as f:
+                labels_list = csv.reader(f)
+                next(labels_list)
+                for k, r, v in labels_list:
+                    add(r + '/' + k + suffix, r, int(v))
+
+        splits = {}
+        mtimes = {}
+        for filelist in filelists:
+            path = os.path.join(filelist_path, filelist)
+            with open(path, 'r') as f:
+                ids = [line.rstrip() for line in f if line.strip()]
+            for item in ids:
+                if item not in rows:
+                    add(item, item.split('/')[0], -1)
+            splits[filelist] = np.array([rows[item] for item in ids], dtype=np.int32)
+            mtimes[filelist] = os.path.getmtime(path)
+
+        items = np.zeros(len(records), dtype=ITEM_DTYPE)
+        items['item'] = [r[0].encode() for r in records]
+        items['dataset'] = [r[1] for r in records]
+        items['label'] = [r[2] for r in records]
+        items['frames'] = -1
+        items['shard'] = -1
+        items['offset'] = -1
+        source_mtime = 0
+        if spect_path is not None:
+            # read first, features written during the scan make the catalog stale
+            source_mtime = features_mtime(spect_path, features, set(os.path.dirname(r[0]) for r in records))
+            shards = {}
+            # test filelist ids end in '.wav.wav', 8 characters replaced by '.mfc'
+            extents = [_feature_extent(spect_path, features, r[0], shards,
+                                       8 if r[0].endswith('.wav.wav') else 4)
+                       for r in records]
+            if extents:
+                items['frames'], items['shard'], items['offset'] = zip(*extents)
+        return cls(items, names, splits, mtimes, labels_mtime,
+                   spect_path, features if spect_path is not None else None, source_mtime)
+
+    def save(self, path):
+        arrays = {'items': self.items, 'datasets': np.array(self.datasets),
+                  'labels_mtime': np.float64(self.labels_mtime),
+                  'spect_path': np.array(self.spect_path or ''),
+                  'features': np.array(self.features or ''),
+                  'features_mtime': np.float64(self.features_mtime)}
+        for name, rows in self.splits.items():
+            arrays[SPLIT_PREFIX + name] = rows
+            arrays[MTIME_PREFIX + name] = np.float64(self.mtimes.get(name, 0))
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            splits = {}
+            mtimes = {}
+            for key in stored.files:
+                if key.startswith(SPLIT_PREFIX):
+                    name = key[len(SPLIT_PREFIX):]
+                    splits[name] = stored[key]
+                    mtimes[name] = float(stored[MTIME_PREFIX + name])
+            # catalogs saved before the feature source was recorded have none
+            spect_path = str(stored['spect_path']) if 'spect_path' in stored.files else ''
+            features = str(stored['features']) if 'features' in stored.files else ''
+            source_mtime = float(stored['features_mtime']) if 'features_mtime' in stored.files else 0
+            return cls(stored['items'], stored['datasets'].tolist(), splits, mtimes,
+                       float(stored['labels_mtime']), spect_path or None, features or None,
+                       source_mtime)
+
+    def __len__(self):
+        return len(self.items)
+
+    def split(self, name):
+        """ Item ids of a filelist, in filelist order. """
+        return [item.decode() for item in self.items['item'][self.splits[name]]]
+
+    def split_size(self, name):
+        return len(self.splits[name])
+
+    def frames(self, name):
+        return self.items['frames'][self.splits[name]]
+
+    def labels(self):
+        """ Dict item id -> label as a string, as read_labels returns. """
+        labelled = self.items[self.items['label'] >= 0]
+        return {item.decode(): str(label) for item, label in zip(labelled['item'], labelled['label'])}
+
+    def class_counts(self, name):
+        """ Number of items of each label (-1 for unlabelled) in a filelist. """
+        values, counts = np.unique(self.items['label'][self.splits[name]], return_counts=True)
+        return dict(zip(values.tolist(), counts.tolist()))
+
+    def is_stale(self, filelist_path, filelists, label_path=None, datasets=(),
+                 spect_path=None, features='npy'):
+        """ True if a filelist is missing from the catalog or a filelist or
+            label CSV was modified since it was built. With spect_path, also
+            if the frame counts come from other feature files, or an item of
+            the filelists has none and feature files were added since the
+            build (items without features keep -1 otherwise).
+        """
+        for name in datasets:
+            if os.path.getmtime(os.path.join(label_path, name)) > self.labels_mtime:
+                return True
+        for filelist in filelists:
+            if filelist not in self.splits:
+                return True
+            if os.path.getmtime(os.path.join(filelist_path, filelist)) != self.mtimes[filelist]:
+                return True
+        if spect_path is not None:
+            if self.spect_path is None or self.features != features or \
+                    os.path.abspath(self.spect_path) != os.path.abspath(spect_path):
+                return True
+            missing = self.missing_frames(filelists)
+            if missing and features_mtime(spect_path, features, set(
+                    os.path.dirname(item) for item in missing)) > self.features_mtime:
+                return True
+        return False
+
+    def missing_frames(self, filelists):
+        """ Item ids of the filelists without a feature file. """
+        missing = []
+        for filelist in filelists:
+            rows = self.splits[filelist]
+            missing.extend(item.decode() for item in self.items['item'][rows[self.items['frames'][rows] < 0]])
+        return missing
+
+
+def open_catalog(path, label_path, datasets, filelist_path, filelists,
+                 spect_path=None, features='npy'):
+    """ Loads the catalog at path, building and saving it first if it does
+        not exist or is stale (see Catalog.is_stale).
+    """
+    if os.path.exists(path):
+        catalog = Catalog.load(path)
+        if not catalog.is_stale(filelist_path, filelists, label_path, datasets,
+                                spect_path, features):
+            _log_missing(catalog, filelists, spect_path)
+            return catalog
+        # keep the splits already in the catalog
+        filelists = sorted(set(filelists) | set(
+            name for name in catalog.splits
+            if os.path.exists(os.path.join(filelist_path, name))))
+    catalog = Catalog.build(label_path, datasets, filelist_path, filelists,
+                            spect_path, features)
+    catalog.save(path)
+    _log_missing(catalog, filelists, spect_path)
+    return catalog
+
+
+def _log_missing(catalog, filelists, spect_path):
+    if spect_path is None:
+        return
+    missing = catalog.missing_frames(filelists)
+    if missing:
+        logger.warning('{} items without feature files (frames -1), e.g. {}'.format(len(missing), missing[0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the dataset catalog')
+    parser.add_argument('label_path', help='Directory of the label CSVs')
+    parser.add_argument('filelist_path', help='Directory of the filelists')
+    parser.add_argument('output', help='Catalog file (.npz)')
+    parser.add_argument('--datasets', nargs='+',
+                        default=['BirdVox-DCASE-20k.csv', 'ff1010bird.csv',
+                                 'warblrb10k.csv'],
+                        help='Label CSVs')
+    parser.add_argument('--filelists', nargs='*', default=None,
+                        help='Filelists to store, all the files of '
+                        'filelist_path by default')
+    parser.add_argument('--spect-path', default=None,
+                        help='Root of the feature files, for the frame counts')
+    parser.add_argument('--features', default='npy',
+                        choices=['npy', 'npz', 'shard', 'mfc', 'h5'])
+    args = parser.parse_args()
+
+    filelists = args.filelists
+    if filelists is None:
+        filelists = sorted(name for name in os.listdir(args.filelist_path)
+                           if os.path.isfile(os.path.join(args.filelist_path, name)))
+    catalog = Catalog.build(args.label_path, args.datasets, args.filelist_path,
+                            filelists, args.spect_path, args.features)
+    catalog.save(args.output)
+    print('{} items, {} datasets'.format(len(catalog), len(catalog.datasets)))
+    for name in sorted(catalog.splits):
+        print('{}: {} items {}'.format(name, catalog.split_size(name), catalog.class_counts(name)))
+
+
+if __name__ == '__main__':
+    main()
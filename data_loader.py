@@ -0,0 +1,391 @@
+import csv
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+from keras.utils import Sequence
+from HTK import HTKFile
+from feature_store import load_features, fit_to_shape, ShardSet
+
+# Data loading for birddet_baseline.py: one keras Sequence for the train,
+# validation and test splits, usable with fit_generator workers or through
+# a Prefetcher filling reused batch buffers on background threads.
+
+
+def read_filelist(filelistpath):
+    with open(filelistpath, 'r') as filelist:
+        return [line.rstrip() for line in filelist if line.strip()]
+
+
+def read_labels(label_path, datasets, suffix='.wav'):
+    """ Reads the label CSVs in a dict '<datasetid>/<itemid><suffix>' -> hasbird. """
+    labels_dict = {}
+    for name in datasets:
+        with open(label_path + name, 'r') as f:
+            labels_list = csv.reader(f)
+            next(labels_list)
+            for k, r, v in labels_list:
+                labels_dict[r + '/' + k + suffix] = v
+    return labels_dict
+
+
+class FeatureReader:
+    """ Loads the features of one filelist item in the configured format. """
+
+    def __init__(self, spect_path, features='npy', max_value=0, min_value=0, online_features=None):
+        """ Args:
+                spect_path (string): Root of the feature files (SPECTPATH).
+                features (string): 'npy', 'npz', 'shard', 'mfc', 'h5' or 'wav'.
+                max_value, min_value (float): Fixed min-max normalization of npy/npz/shard features, 0 disables it.
+                online_features (OnlineFeatures): Feature extractor for 'wav'.
+        """
+        self.spect_path = spect_path
+        self.features = features
+        self.max_value = max_value
+        self.min_value = min_value
+        self.online_features = online_features
+        self.shard_store = ShardSet(spect_path) if features == 'shard' else None
+
+    def load(self, file_id, mfc_suffix=4):
+        """ mfc_suffix: characters of file_id replaced by '.mfc' (8 in the test filelists). """
+        # load features with the select format
+        if self.features == 'h5':
+            hf = h5py.File(self.spect_path + file_id + '.h5', 'r')
+            imagedata = hf.get('features')
+            imagedata = np.array(imagedata)
+            hf.close()
+            return (imagedata + 15.0966)/(15.0966 + 2.25745)
+        elif self.features == 'mfc':
+            htk_reader = HTKFile()
+            imagedata = htk_reader.load(self.spect_path + file_id[:-mfc_suffix] + '.mfc')
+            return imagedata / 17.0
+        elif self.features == 'wav':
+            return self.online_features.get(file_id)
+        elif self.features == 'npy':
+            imagedata = np.load(self.spect_path + file_id + '.npy')
+        elif self.features == 'npz':
+            imagedata = load_features(self.spect_path + file_id + '.npz')
+        elif self.features == 'shard':
+            imagedata = np.array(self.shard_store.get(file_id), dtype=np.float32)
+        else:
+            raise ValueError('Unknown features type {}'.format(self.features))
+        if self.max_value != 0 and self.min_value != 0:
+            imagedata = (imagedata - self.min_value)/(self.max_value - self.min_value)
+        return imagedata
+
+    def prefetch(self, file_ids):
+        if self.online_features is not None:
+            self.online_features.prefetch(file_ids)
+
+
+class DataLoader(Sequence):
+    """ Batches of one split for fit_generator / predict_generator.
+        mode 'train' and 'val' return (inputs, outputs), 'test' only inputs.
+        The order is reshuffled at every epoch from seed + epoch, so runs are
+        reproducible, and the last batch holds the remaining items instead of
+        wrapping to the start of the filelist.
+    """
+
+    def __init__(self, filelist, reader, mode='train', batch_size=16, shuffle=False, seed=0,
+                 labels=None, expected_shape=(1000, 180), feature_stats=None, norm_mode='none',
+                 norm_method='minmax', augmenter=None, augment_size=1, tensor_cache=None,
+                 dtype='float32', mfc_suffix=None, class_weight=None):
+        """ Args:
+                filelist (string or list): Filelist of the split, or its item ids (Catalog.split).
+                reader (FeatureReader): Loads the features of an item.
+                mode (string): 'train', 'val' or 'test'.
+                labels (dict): Item -> label, required unless mode is 'test'.
+                feature_stats (FeatureStats): Statistics for the 'global' or 'bin' norm_mode.
+                augmenter (BatchAugmenter): Adds augment_size - 1 augmented copies of every item.
+                tensor_cache (TensorCache): Keeps the finished tensors of the items across
+                    epochs, can be shared by loaders with the same reader and normalization.
+                dtype (string): Batch dtype, 'float32' or 'float16'.
+                mfc_suffix (int): See FeatureReader.load, defaults to 8 for 'test' and 4 otherwise.
+                class_weight (dict): Class -> loss weight. The batches then carry per-sample
+                    weights, mixed with the labels by mixup, instead of the class_weight
+                    of fit_generator (which rejects the soft labels of mixup).
+        """
+        self.filenames = read_filelist(filelist) if isinstance(filelist, str) else list(filelist)
+        self.reader = reader
+        self.mode = mode
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.labels = labels
+        self.expected_shape = expected_shape
+        self.feature_stats = feature_stats
+        self.norm_mode = norm_mode
+        self.norm_method = norm_method
+        self.augmenter = augmenter
+        self.augment_size = augment_size if augmenter is not None else 1
+        self.tensor_cache = tensor_cache
+        self.dtype = np.dtype(dtype)
+        self.mfc_suffix = mfc_suffix if mfc_suffix is not None else (8 if mode == 'test' else 4)
+        self.class_weight = class_weight if mode != 'test' else None
+        self.epoch = 0
+        self._set_order()
+
+    def _set_order(self):
+        self.order = np.arange(len(self.filenames))
+        if self.shuffle:
+            np.random.RandomState(self.seed + self.epoch).shuffle(self.order)
+
+    def __len__(self):
+        return int(np.ceil(len(self.filenames) * self.augment_size / float(self.batch_size)))
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self._set_order()
+
+    def batch_items(self, idx):
+        """ Filelist items of batch idx, one entry per augmented copy. """
+        rows = range(idx * self.batch_size, min((idx + 1) * self.batch_size,
+                                                len(self.filenames) * self.augment_size))
+        return [(self.filenames[self.order[r // self.augment_size]], r % self.augment_size) for r in rows]
+
+    def batch_length(self, idx):
+        """ Frames of the items of batch idx. """
+        return self.expected_shape[0]
+
+    def max_length(self):
+        """ Upper bound of batch_length, for preallocated batches. """
+        return self.expected_shape[0]
+
+    def fit(self, imagedata, length):
+        return fit_to_shape(imagedata, (length, self.expected_shape[1]))
+
+    def item_tensor(self, file_id, length, mfc_suffix):
+        """ Loaded, fitted and normalized (length, features, 1) tensor of an item. """
+        # no-op for features already fitted by preprocess_signal.py --fit
+        imagedata = self.fit(self.reader.load(file_id, mfc_suffix), length)
+        imagedata = np.reshape(imagedata, (imagedata.shape[0], imagedata.shape[1], 1))
+        if self.feature_stats is not None and self.norm_mode != 'none':
+            imagedata = self.feature_stats.normalize(imagedata, self.norm_mode == 'bin',
+                                                     self.norm_method, axis=1)
+        return imagedata
+
+    def _cache_key(self, file_id, length):
+        return '{}:{}'.format(file_id, length)
+
+    def __getitem__(self, idx):
+        length = self.batch_length(idx)
+        n_items = len(self.batch_items(idx))
+        batch = self.fill_batch(
+            idx, np.zeros([n_items, length, self.expected_shape[1], 1], dtype=self.dtype),
+            np.zeros([n_items, 1], dtype=np.float32))
+        if self.mode == 'test':
+            return [batch[0]]
+        if self.class_weight is not None:
+            return [batch[0]], [batch[1]], batch[2]
+        return [batch[0]], [batch[1]]
+
+    def fill_batch(self, idx, spect_batch, label_batch):
+        """ Writes batch idx in the first rows and frames of preallocated arrays
+            (at least (batch_size, batch_length, features, 1) and (batch_size, 1)).
+            Returns the views holding the batch, and the sample weights with class_weight.
+        """
+        items = self.batch_items(idx)
+        # start loading the next batch in the background ('wav' features)
+        if idx + 1 < len(self):
+            next_length = self.batch_length(idx + 1)
+            self.reader.prefetch([file_id for file_id, _ in self.batch_items(idx + 1)
+                                  if self.tensor_cache is None
+                                  or self._cache_key(file_id, next_length) not in self.tensor_cache])
+
+        length = self.batch_length(idx)
+        spect_batch = spect_batch[:len(items), :length]
+        label_batch = label_batch[:len(items)]
+        mfc_suffix = self.mfc_suffix
+        for n, (file_id, copy) in enumerate(items):
+            if self.tensor_cache is not None:
+                key = self._cache_key(file_id, length)
+                imagedata = self.tensor_cache.get(key)
+                if imagedata is None:
+                    imagedata = self.tensor_cache.put(key, self.item_tensor(file_id, length, mfc_suffix))
+            else:
+                imagedata = self.item_tensor(file_id, length, mfc_suffix)
+            spect_batch[n, :, :, :] = imagedata
+            if self.mode != 'test':
+                label_batch[n, :] = float(self.labels[file_id])
+
+        weight_batch = None
+        if self.class_weight is not None:
+            weight_batch = np.array([self.class_weight[int(label)] for label in label_batch[:, 0]],
+                                    dtype=np.float32)
+        # the copies of the items are augmented, the same for any worker order
+        if self.augmenter is not None:
+            rng = np.random.RandomState(self.seed + self.epoch * 1000003 + idx)
+            self.augmenter.augment(spect_batch, label_batch, [n for n, (_, copy) in enumerate(items) if copy > 0],
+                                   rng, weight_batch)
+        if weight_batch is not None:
+            return spect_batch, label_batch, weight_batch
+        return spect_batch, label_batch
+
+
+class BucketLoader(DataLoader):
+    """ DataLoader for models accepting any number of frames (global pooling
+        head): items of similar length are batched together at the length of
+        the longest one, so the compute follows the audio length instead of
+        expected_shape.
+        Items are grouped in buckets of bucket_width frames, shorter items of
+        a batch are repeated (wrap) up to its length. Items are shuffled
+        inside their bucket and batches are shuffled across buckets every
+        epoch, the number of batches does not change between epochs.
+    """
+
+    def __init__(self, filelist, reader, frames, mode='train', batch_size=16, bucket_width=100,
+                 min_frames=200, max_frames=3000, **kwargs):
+        """ Args:
+                frames (array): Frames of every filelist item, as Catalog.frames.
+                    Unknown lengths (-1) count as expected_shape frames.
+                bucket_width (int): Frames spanned by a bucket.
+                min_frames (int): Shorter items are repeated up to it, the model
+                    needs a minimum input length.
+                max_frames (int): Longer items are fitted to it as fit_to_shape does.
+            The other arguments are the ones of DataLoader.
+        """
+        self.frames = np.asarray(frames, dtype=np.int64)
+        self.bucket_width = bucket_width
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        DataLoader.__init__(self, filelist, reader, mode, batch_size, **kwargs)
+
+    def _set_order(self):
+        frames = np.where(self.frames < 0, self.expected_shape[0], self.frames)
+        frames = np.clip(frames, self.min_frames, self.max_frames)
+        buckets = (frames - 1) // self.bucket_width
+        rng = np.random.RandomState(self.seed + self.epoch)
+        rows = np.arange(len(self.filenames) * self.augment_size)
+        self.batches = []
+        for bucket in np.unique(buckets):
+            bucket_rows = rows[buckets[rows // self.augment_size] == bucket]
+            if self.shuffle:
+                rng.shuffle(bucket_rows)
+            for n in range(0, len(bucket_rows), self.batch_size):
+                batch_rows = bucket_rows[n:n + self.batch_size]
+                self.batches.append((batch_rows, int(frames[batch_rows // self.augment_size].max())))
+        if self.shuffle:
+            rng.shuffle(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def batch_items(self, idx):
+        rows, _ = self.batches[idx]
+        return [(self.filenames[r // self.augment_size], r % self.augment_size) for r in rows]
+
+    def batch_length(self, idx):
+        return self.batches[idx][1]
+
+    def max_length(self):
+        frames = np.where(self.frames < 0, self.expected_shape[0], self.frames)
+        return int(np.clip(frames, self.min_frames, self.max_frames).max()) if len(frames) else self.min_frames
+
+    def item_order(self):
+        """ Filelist index of every item in batch order, to put predictions back in filelist order. """
+        return np.concatenate([rows // self.augment_size for rows, _ in self.batches])
+
+    def fit(self, imagedata, length):
+        if imagedata.shape[0] > self.max_frames:
+            imagedata = fit_to_shape(imagedata, (self.max_frames, imagedata.shape[1]))
+        if imagedata.shape[0] < length:
+            imagedata = np.pad(imagedata, ((0, length - imagedata.shape[0]), (0, 0)), mode='wrap')
+        return imagedata[:length]
+
+
+class Prefetcher:
+    """ Iterator over the batches of a loader for fit_generator, evaluate_generator
+        and predict_generator with workers=0.
+        Background threads fill up to depth batches ahead while the model runs
+        on the current one, into depth + 1 preallocated buffers that are
+        reused once the model has consumed them. Batches come out in order,
+        len(loader) per epoch. Once every batch of an epoch is filled the
+        loader moves to the next epoch and its first batches are queued
+        right away, so the first batch of an epoch does not wait either
+        (the order is never changed under a batch being filled).
+        wait_time accumulates the time the consumer waited for a batch that
+        was not ready (I/O or preparation bound when it grows), epoch_stats
+        keeps it per epoch. items holds the batch_items of the last batch.
+    """
+
+    def __init__(self, loader, workers=2, depth=4):
+        """ Args:
+                loader (DataLoader): Batches to prefetch, its dtype is the buffer dtype.
+                workers (int): Filling threads, NumPy and file reads release the GIL.
+                depth (int): Batches prepared ahead.
+        """
+        self.loader = loader
+        self.depth = depth
+        self.pool = ThreadPoolExecutor(workers)
+        shape = (loader.batch_size, loader.max_length(), loader.expected_shape[1], 1)
+        self.free = [(np.zeros(shape, dtype=loader.dtype), np.zeros((loader.batch_size, 1), dtype=np.float32))
+                     for _ in range(depth + 1)]
+        self.pending = deque()
+        self.consumed = None
+        self.items = None
+        self.next_idx = 0
+        self.batches = 0
+        self.wait_time = 0.0
+        self.fill_time = 0.0
+        self.epoch_stats = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        return self
+
+    def _fill(self, idx, buffers):
+        start = time.time()
+        batch = self.loader.fill_batch(idx, *buffers)
+        # the items of the batch, the loader may be in the next epoch when it comes out
+        items = self.loader.batch_items(idx)
+        return batch, items, buffers, time.time() - start
+
+    def _submit(self):
+        while len(self.pending) < self.depth and self.free and self.next_idx < len(self.loader):
+            self.pending.append(self.pool.submit(self._fill, self.next_idx, self.free.pop()))
+            self.next_idx += 1
+
+    def _advance(self):
+        # next epoch of the loader once all the batches of this one are filled
+        if self.next_idx >= len(self.loader) and all(future.done() for future in self.pending):
+            self.loader.on_epoch_end()
+            self.next_idx = 0
+
+    def _end_epoch(self):
+        self.epoch_stats.append({'epoch': len(self.epoch_stats), 'batches': self.batches,
+                                 'wait_time': self.wait_time, 'fill_time': self.fill_time})
+        self.batches = 0
+        self.wait_time = 0.0
+        self.fill_time = 0.0
+
+    def __next__(self):
+        # the model is done with the previous batch
+        if self.consumed is not None:
+            self.free.append(self.consumed)
+            self.consumed = None
+        if self.batches >= len(self.loader):
+            self._end_epoch()
+        self._advance()
+        self._submit()
+        future = self.pending.popleft()
+        start = time.time()
+        batch, self.items, self.consumed, fill_time = future.result()
+        self.wait_time += time.time() - start
+        self.fill_time += fill_time
+        self.batches += 1
+        self._advance()
+        self._submit()
+        if self.loader.mode == 'test':
+            return batch[0]
+        return batch
+
+    def report(self):
+        """ Summary of the current epoch. """
+        return '{} batches, waited {:.2f} s for data, {:.2f} s filling batches'.format(
+            self.batches, self.wait_time, self.fill_time)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,171 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+from frozen_model import load_model
+from feature_store import fit_to_shape, load_stats
+from preprocess_signal import define_param, save_spectrogram_stream
+
+# Bird activity detection over recordings of any length: the model slides
+# over the spectrogram of the whole recording, computed once and read
+# through np.memmap, and the windows are scored in large batches.
+
+
+def window_starts(n_frames, window, hop):
+    """ First frame of every window, the last one ends with the recording. """
+    if n_frames <= window:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.arange(0, n_frames - window + 1, hop)
+    if starts[-1] + window < n_frames:
+        starts = np.append(starts, n_frames - window)
+    return starts
+
+
+def prepare_windows(batch, top_db=80.0, norm='individual', feature_stats=None,
+                    norm_mode='none', norm_method='minmax'):
+    """ Applies to every window of a (windows, frames, bins) batch, in place,
+        the per clip processing of the training features: top_db clipping
+        below the window peak, the 'individual' min-max normalization and the
+        'global' or 'bin' normalization of the loaders with feature_stats
+        (features preprocessed with --norm full).
+    """
+    if top_db is not None:
+        np.maximum(batch, batch.max(axis=(1, 2), keepdims=True) - top_db, out=batch)
+    if norm == 'individual':
+        xmin = batch.min(axis=(1, 2), keepdims=True)
+        xmax = batch.max(axis=(1, 2), keepdims=True)
+        batch -= xmin
+        batch /= np.where(xmax > xmin, xmax - xmin, 1.0)
+    if feature_stats is not None and norm_mode != 'none':
+        batch[...] = feature_stats.normalize(batch, norm_mode == 'bin', norm_method, axis=2)
+    return batch
+
+
+def detect(model, spectrogram, window=1000, hop=250, batch_size=128, top_db=80.0, norm='individual',
+           feature_stats=None, norm_mode='none', norm_method='minmax'):
+    """ Probability of every window of a (frames, bins) spectrogram.
+        The windows of a batch are copied into a reused buffer from one block
+        of frames, so overlapping frames are read once from disk per batch.
+        Returns:
+            (ndarray, ndarray): First frame and probability of every window.
+    """
+    n_frames, n_bins = spectrogram.shape
+    starts = window_starts(n_frames, window, hop)
+    if n_frames < window:
+        # repeated up to the window as the short training clips
+        spectrogram = fit_to_shape(np.asarray(spectrogram), (window, n_bins))
+    buffer = np.zeros((batch_size, window, n_bins, 1), dtype=np.float32)
+    probabilities = np.zeros(len(starts), dtype=np.float32)
+    for n in range(0, len(starts), batch_size):
+        batch_starts = starts[n:n + batch_size]
+        batch = buffer[:len(batch_starts)]
+        # the hop frames between two windows are the only new ones, read a
+        # contiguous block once and take the windows from it
+        block = np.asarray(spectrogram[batch_starts[0]:batch_starts[-1] + window])
+        for k, start in enumerate(batch_starts - batch_starts[0]):
+            batch[k, :, :, 0] = block[start:start + window]
+        prepare_windows(batch[..., 0], top_db, norm, feature_stats, norm_mode, norm_method)
+        probabilities[n:n + len(batch_starts)] = np.asarray(model.predict_on_batch(batch)).reshape(-1)
+    return starts, probabilities
+
+
+def merge_segments(starts, probabilities, window, frame_s, threshold=0.5, max_gap=0.0):
+    """ Merges the windows above threshold into (start s, end s, max probability)
+        segments, joining the ones separated by max_gap seconds or less.
+    """
+    segments = []
+    for start, probability in zip(starts, probabilities):
+        if probability < threshold:
+            continue
+        begin, end = start * frame_s, (start + window) * frame_s
+        if segments and begin - segments[-1][1] <= max_gap:
+            segments[-1] = [segments[-1][0], max(end, segments[-1][1]), max(probability, segments[-1][2])]
+        else:
+            segments.append([begin, end, probability])
+    return segments
+
+
+def load_spectrogram(path, options, spec_type, work_dir):
+    """ Memory-mapped spectrogram of a .npy file, or of a wav computed with
+        the streaming front end into work_dir.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    output_file = os.path.join(work_dir, os.path.basename(path) + '.npy')
+    if not os.path.exists(output_file) or os.path.getmtime(output_file) < os.path.getmtime(path):
+        save_spectrogram_stream(path, output_file, options, spec_type)
+    return np.load(output_file, mmap_mode='r')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sliding window bird detection over long recordings')
+    parser.add_argument('model', help='Keras model (.h5) or exported model (.npz)')
+    parser.add_argument('inputs', nargs='+', help='Wavs or .npy spectrograms (preprocess_signal.py --stream)')
+    parser.add_argument('--output', default='detections', help='Directory of the output CSVs')
+    parser.add_argument('--weights', default=None, help='Weights loaded by name after the model')
+    parser.add_argument('--process', default='frequential', help='define_param option set of the features')
+    parser.add_argument('--type', default='mel', choices=['normal', 'mel'])
+    parser.add_argument('--norm', default='individual', choices=['none', 'individual', 'full'],
+                        help='Per window normalization, full for models trained on --norm full features')
+    parser.add_argument('--norm-stats', nargs='*', default=None,
+                        help='Statistics files for the global/bin normalization')
+    parser.add_argument('--norm-mode', default='none', choices=['none', 'global', 'bin'])
+    parser.add_argument('--norm-method', default='minmax', choices=['minmax', 'standard'])
+    parser.add_argument('--window', type=int, default=None,
+                        help='Window in frames, the model input length by default')
+    parser.add_argument('--hop', type=int, default=250, help='Hop between windows in frames')
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--max-gap', type=float, default=0.0,
+                        help='Segments closer than this (seconds) are merged')
+    parser.add_argument('--work-dir', default=None,
+                        help='Where the spectrograms of the wavs are kept, --output by default')
+    args = parser.parse_args()
+    if args.norm_mode != 'none' and not args.norm_stats:
+        parser.error('--norm-mode {} needs --norm-stats'.format(args.norm_mode))
+
+    options = define_param(args.process)
+    feature_stats = load_stats(args.norm_stats) if args.norm_stats else None
+    frame_s = int(options['HOP_t'] * options['FS']) / float(options['FS'])
+    model = load_model(args.model, args.weights)
+    window = args.window or model.input_shape[1] or options['expected_len']
+    work_dir = args.work_dir or args.output
+    for directory in (args.output, work_dir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    total_audio = 0.0
+    total_cpu = 0.0
+    for path in args.inputs:
+        cpu = time.process_time()
+        spectrogram = load_spectrogram(path, options, args.type, work_dir)
+        starts, probabilities = detect(model, spectrogram, window, args.hop, args.batch_size,
+                                       norm=args.norm if args.norm == 'individual' else None,
+                                       feature_stats=feature_stats, norm_mode=args.norm_mode,
+                                       norm_method=args.norm_method)
+        cpu = time.process_time() - cpu
+        audio = len(spectrogram) * frame_s
+        total_audio += audio
+        total_cpu += cpu
+
+        name = os.path.basename(path)
+        with open(os.path.join(args.output, name + '.windows.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['start', 'end', 'probability'])
+            writer.writerows(('{:.3f}'.format(start * frame_s), '{:.3f}'.format((start + window) * frame_s),
+                              float(p)) for start, p in zip(starts, probabilities))
+        segments = merge_segments(starts, probabilities, window, frame_s, args.threshold, args.max_gap)
+        with open(os.path.join(args.output, name + '.segments.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['start', 'end', 'max_probability'])
+            writer.writerows(('{:.3f}'.format(begin), '{:.3f}'.format(end), float(p)) for begin, end, p in segments)
+        print('{}: {:.1f} s of audio, {} windows, {} segments, {:.1f} CPU s'.format(
+            name, audio, len(starts), len(segments), cpu))
+
+    # process_time counts the CPU time of every thread of the process
+    print('Throughput: {:.1f} audio hours per CPU hour'.format(total_audio / max(total_cpu, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
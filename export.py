@@ -0,0 +1,162 @@
+import argparse
+import numpy as np
+from frozen_model import FrozenModel, WEIGHT_OPS, load_model
+from data_loader import DataLoader, FeatureReader, read_filelist
+from feature_store import load_stats
+
+# Export of a trained Keras model to the NumPy runtime of frozen_model.py:
+# BatchNormalization folded in the previous convolution or dense layer,
+# Dropout removed, and optionally int8 weights with input scales calibrated
+# on a sample of the feature store.
+
+
+def _padding_strides(config):
+    return config.get('padding', 'valid'), list(config.get('strides') or config['pool_size'])
+
+
+def freeze(model):
+    """ Returns the FrozenModel of a Sequential-like Keras model (layers applied in order). """
+    ops = []
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        config = layer.get_config()
+        weights = layer.get_weights()
+        if kind in ('InputLayer', 'Dropout'):
+            continue
+        if kind == 'Conv2D':
+            if config.get('data_format', 'channels_last') != 'channels_last':
+                raise ValueError('{}: only channels_last is supported'.format(layer.name))
+            ops.append({'op': 'conv', 'W': weights[0], 'b': weights[1] if config['use_bias'] else None,
+                        'strides': list(config['strides']), 'padding': config['padding'],
+                        'activation': config['activation']})
+        elif kind in ('SeparableConv2D', 'DepthwiseConv2D'):
+            # depthwise convolution, then the 1x1 pointwise one of SeparableConv2D
+            if config.get('data_format', 'channels_last') != 'channels_last':
+                raise ValueError('{}: only channels_last is supported'.format(layer.name))
+            separable = kind == 'SeparableConv2D'
+            bias = weights[-1] if config['use_bias'] else None
+            ops.append({'op': 'depthwise', 'W': weights[0], 'b': None if separable else bias,
+                        'strides': list(config['strides']), 'padding': config['padding'],
+                        'activation': 'linear' if separable else config['activation']})
+            if separable:
+                ops.append({'op': 'conv', 'W': weights[1], 'b': bias, 'strides': [1, 1], 'padding': 'valid',
+                            'activation': config['activation']})
+        elif kind == 'Dense':
+            ops.append({'op': 'dense', 'W': weights[0], 'b': weights[1] if config['use_bias'] else None,
+                        'activation': config['activation']})
+        elif kind == 'BatchNormalization':
+            gamma = weights.pop(0) if config['scale'] else 1.0
+            beta = weights.pop(0) if config['center'] else 0.0
+            mean, var = weights
+            scale = gamma / np.sqrt(var + config['epsilon'])
+            shift = beta - mean * scale
+            previous = ops[-1] if ops else None
+            if previous is not None and previous['op'] in ('conv', 'dense') and previous['activation'] == 'linear':
+                # folded: W' = W * scale per output channel, b' = b * scale + shift
+                previous['W'] = previous['W'] * scale
+                previous['b'] = (previous['b'] if previous['b'] is not None else 0.0) * scale + shift
+            else:
+                ops.append({'op': 'affine', 'W': scale, 'b': shift})
+        elif kind == 'LeakyReLU':
+            ops.append({'op': 'activation', 'activation': 'leaky_relu', 'alpha': float(config['alpha'])})
+        elif kind == 'Activation':
+            ops.append({'op': 'activation', 'activation': config['activation']})
+        elif kind in ('MaxPooling2D', 'AveragePooling2D'):
+            padding, strides = _padding_strides(config)
+            ops.append({'op': 'maxpool' if kind == 'MaxPooling2D' else 'avgpool',
+                        'pool': list(config['pool_size']), 'strides': strides, 'padding': padding})
+        elif kind == 'Flatten':
+            ops.append({'op': 'flatten'})
+        elif kind == 'GlobalAveragePooling2D':
+            ops.append({'op': 'global_avgpool'})
+        elif kind == 'GlobalMaxPooling2D':
+            ops.append({'op': 'global_maxpool'})
+        else:
+            raise ValueError('{}: layer {} can not be exported'.format(layer.name, kind))
+    for op in ops:
+        if op.get('b', 0) is None:
+            del op['b']
+        for key in ('W', 'b'):
+            if key in op:
+                op[key] = np.asarray(op[key], dtype=np.float32)
+    return FrozenModel(ops, tuple(model.input_shape))
+
+
+def quantize(frozen, calibration):
+    """ int8 weights (symmetric, per output channel) and int8 input steps of
+        every convolution and dense layer, from the largest input seen on
+        the calibration batch.
+    """
+    peaks = {}
+
+    def observe(n, x):
+        peaks[n] = max(peaks.get(n, 0.0), float(np.max(np.abs(x))))
+
+    for n in range(0, len(calibration), 32):
+        frozen.run(calibration[n:n + 32], observe)
+    for n, op in enumerate(frozen.ops):
+        if op['op'] not in WEIGHT_OPS:
+            continue
+        # per output channel, (channel, multiplier) pairs for depthwise kernels
+        axes = (0, 1) if op['op'] == 'depthwise' else tuple(range(op['W'].ndim - 1))
+        w_scale = np.max(np.abs(op['W']), axis=axes) / 127.0
+        w_scale = np.where(w_scale > 0, w_scale, 1.0).astype(np.float32)
+        op['Wq'] = np.round(op['W'] / w_scale).astype(np.int8)
+        op['Wscale'] = w_scale
+        op['W'] = op['Wq'].astype(np.float32) * w_scale
+        op['in_scale'] = peaks[n] / 127.0 if peaks.get(n, 0.0) > 0 else 1.0
+    return frozen
+
+
+def calibration_batch(filelist, spect_path, features='npy', size=256, seed=0,
+                      expected_shape=(1000, 180), max_value=0, min_value=0,
+                      feature_stats=None, norm_mode='none', norm_method='minmax'):
+    """ Random sample of a filelist loaded and normalized as the training
+        batches (train/val filelist ids, 'mfc' suffix of 4 characters).
+    """
+    file_ids = read_filelist(filelist)
+    rng = np.random.RandomState(seed)
+    file_ids = [file_ids[n] for n in rng.permutation(len(file_ids))[:size]]
+    loader = DataLoader(file_ids, FeatureReader(spect_path, features, max_value, min_value),
+                        'test', len(file_ids), expected_shape=expected_shape, feature_stats=feature_stats,
+                        norm_mode=norm_mode, norm_method=norm_method, mfc_suffix=4)
+    return loader[0][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a Keras model to the NumPy runtime')
+    parser.add_argument('model', help='Keras model (.h5)')
+    parser.add_argument('output', help='Exported model (.npz)')
+    parser.add_argument('--weights', default=None, help='Weights loaded by name after the model')
+    parser.add_argument('--int8', action='store_true', help='Quantize the weights and inputs to int8')
+    parser.add_argument('--calibration-filelist', default=None,
+                        help='Filelist sampled for the int8 calibration')
+    parser.add_argument('--spect-path', default='', help='Root of the feature files')
+    parser.add_argument('--features', default='npy', choices=['npy', 'npz', 'shard', 'mfc', 'h5'])
+    parser.add_argument('--calibration-size', type=int, default=256)
+    parser.add_argument('--max-value', type=float, default=0)
+    parser.add_argument('--min-value', type=float, default=0)
+    parser.add_argument('--norm-stats', nargs='*', default=None,
+                        help='Statistics files for the global/bin normalization')
+    parser.add_argument('--norm-mode', default='none', choices=['none', 'global', 'bin'])
+    parser.add_argument('--norm-method', default='minmax', choices=['minmax', 'standard'])
+    args = parser.parse_args()
+    if args.int8 and args.calibration_filelist is None:
+        parser.error('--int8 needs --calibration-filelist')
+
+    model = load_model(args.model, args.weights)
+    frozen = freeze(model)
+    if args.int8:
+        _, frames, n_features, _ = model.input_shape
+        calibration = calibration_batch(args.calibration_filelist, args.spect_path, args.features,
+                                        args.calibration_size, expected_shape=(frames or 1000, n_features),
+                                        max_value=args.max_value, min_value=args.min_value,
+                                        feature_stats=load_stats(args.norm_stats) if args.norm_stats else None,
+                                        norm_mode=args.norm_mode, norm_method=args.norm_method)
+        quantize(frozen, calibration)
+    frozen.save(args.output)
+    print('{} operations exported to {}'.format(len(frozen.ops), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+import os
+import json
+import numpy as np
+
+# Storage helpers for the feature files written by preprocess_signal.py
+# and read by the training generators.
+
+# ---- QUANTIZATION LEVELS ---- #
+#   int16: HTK style, values in [-32767, 32767] around the column centre
+#   uint8: values in [0, 255] from the column minimum
+QUANT_TYPES = {'int16': (np.int16, 65534.0, -32767),
+               'uint8': (np.uint8, 255.0, 0),
+               }
+# ----------------------------- #
+
+
+def quantize(data, dtype='int16'):
+    """ Linear per-feature quantization of a (frames, features) array.
+        Returns the quantized array plus the scale and offset vectors with
+        data ~= q * scale + offset.
+    """
+    np_type, levels, q_min = QUANT_TYPES[dtype]
+    data = np.asarray(data, dtype=np.float32)
+    xmax = data.max(axis=0)
+    xmin = data.min(axis=0)
+    scale = np.where(xmax > xmin, (xmax - xmin) / levels, 1.0).astype(np.float32)
+    offset = (xmin - q_min * scale).astype(np.float32)
+    q = np.round((data - offset) / scale)
+    q = np.clip(q, q_min, q_min + levels).astype(np_type)
+    return q, scale, offset
+
+
+def dequantize(q, scale, offset):
+    """ Inverse of quantize, returns a float32 array. """
+    return q.astype(np.float32) * scale + offset
+
+
+# ---- SHARD STORE ---- #
+#   <dir>/shards/index.json : dtype, n_features, shard files and
+#                             item id -> [shard, frame offset, frames]
+#   <dir>/shards/shard_NNN.bin : contiguous (frames, n_features) arrays
+SHARD_DIR = 'shards'
+SHARD_INDEX = 'index.json'
+# --------------------- #
+
+
+def save_features(path, data, compress=None):
+    """ Saves a feature array, as .npy or as quantized .npz if compress is 'int16' or 'uint8'.
+        The extension is appended by NumPy.
+    """
+    if compress in (None, 'none'):
+        np.save(path, data)
+    else:
+        q, scale, offset = quantize(data, compress)
+        np.savez(path, q=q, scale=scale, offset=offset)
+
+
+def load_features(path):
+    """ Loads a .npy feature file or dequantizes a .npz one. """
+    stored = np.load(path)
+    if isinstance(stored, np.ndarray):
+        return stored
+    try:
+        return dequantize(stored['q'], stored['scale'], stored['offset'])
+    finally:
+        stored.close()
+
+
+def fit_to_shape(data, expected_shape):
+    """ Fits a (frames, features) array to expected_shape frames, same result
+        as the original per-sample fix-up of the training generators:
+        short clips are extended with their last frames or repeated, long
+        ones get their first frames averaged with the last ones, or are
+        summed by chunks. A difference of exactly half the expected frames
+        gives zeros, as before.
+    """
+    n = data.shape[0]
+    frames = expected_shape[0]
+    if n == frames:
+        return data
+    if n < frames:
+        diff_in_frames = frames - n
+        if diff_in_frames < frames / 2:
+            return np.concatenate((data, data[n - diff_in_frames:n]))
+        elif diff_in_frames > frames / 2:
+            count = frames // n
+            remaining_diff = frames - n * count
+            return np.concatenate((np.tile(data, (count, 1)), data[n - remaining_diff:n]))
+        return np.zeros(expected_shape)
+
+    diff_in_frames = n - frames
+    fitted = np.zeros(expected_shape)
+    if diff_in_frames < frames / 2:
+        fitted[:diff_in_frames + 1] = (data[:diff_in_frames + 1] + data[n - diff_in_frames - 1:n]) / 2
+        fitted[diff_in_frames + 1:] = data[diff_in_frames + 1:frames]
+    elif diff_in_frames > frames / 2:
+        count = n // frames
+        remaining_diff = n - frames * count
+        tail = data[n - remaining_diff:n]
+        for index in range(count):
+            fitted += data[index * frames:(index + 1) * frames]
+            fitted /= count
+            fitted[:remaining_diff] += tail
+            fitted[:remaining_diff] /= 2
+    return fitted
+
+
+class FeatureStats:
+    """ Mergeable streaming statistics of (frames, features) arrays.
+        Keeps per feature bin min, max, mean and M2 (Welford / Chan et al.
+        parallel update), so partial results from several workers or
+        datasets can be combined with merge.
+    """
+
+    def __init__(self, n_features=None):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        if n_features is not None:
+            self._init(n_features)
+
+    def _init(self, n_features):
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+        self.min = np.full(n_features, np.inf)
+        self.max = np.full(n_features, -np.inf)
+
+    def _combine(self, count, mean, m2, xmin, xmax):
+        if count == 0:
+            return
+        if self.mean is None:
+            self._init(len(mean))
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.min = np.minimum(self.min, xmin)
+        self.max = np.maximum(self.max, xmax)
+        self.count = total
+
+    def update(self, data):
+        """ Adds the frames of a (frames, features) array. """
+        data = np.asarray(data, dtype=np.float64).reshape(-1, np.shape(data)[-1])
+        if len(data) == 0:
+            return
+        mean = data.mean(axis=0)
+        self._combine(len(data), mean, ((data - mean) ** 2).sum(axis=0),
+                      data.min(axis=0), data.max(axis=0))
+
+    def merge(self, other):
+        """ Adds the statistics of another FeatureStats. """
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def global_stats(self):
+        """ Returns (min, max, mean, std) over all the feature bins. """
+        mean = np.mean(self.mean)
+        var = (np.sum(self.m2) + self.count * np.sum((self.mean - mean) ** 2)) / max(self.count * len(self.mean), 1)
+        return np.min(self.min), np.max(self.max), mean, np.sqrt(var)
+
+    def normalize(self, data, per_bin=False, method='minmax', axis=-1):
+        """ Normalizes an array (or a whole batch) with the stored statistics.
+            Args:
+                data (ndarray): Features, the feature bins along axis.
+                per_bin (bool): Use per bin statistics instead of global ones.
+                method (string): 'minmax' maps to [0, 1], 'standard' to zero mean and unit variance.
+                axis (int): Axis of the feature bins, used when per_bin is True.
+        """
+        if per_bin:
+            shape = [1] * np.ndim(data)
+            shape[axis] = len(self.mean)
+            xmin, xmax = self.min.reshape(shape), self.max.reshape(shape)
+            mean, std = self.mean.reshape(shape), self.std.reshape(shape)
+        else:
+            xmin, xmax, mean, std = self.global_stats()
+        if method == 'minmax':
+            shift, scale = xmin, np.where(xmax > xmin, xmax - xmin, 1.0)
+        elif method == 'standard':
+            shift, scale = mean, np.where(std > 0, std, 1.0)
+        else:
+            raise ValueError('Unknown normalization method {}'.format(method))
+        return ((data - shift) / scale).astype(np.float32)
+
+    def save(self, path, **extra):
+        """ Saves the statistics, extra arrays are stored along (ignored by load).
+            Without any frame the arrays are saved empty with count 0.
+        """
+        arrays = dict(extra, count=self.count)
+        for key in ('mean', 'm2', 'min', 'max'):
+            value = getattr(self, key)
+            arrays[key] = np.zeros(0) if value is None else value
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        stats = cls()
+        with np.load(path) as stored:
+            if int(stored['count']) == 0:
+                return stats
+            stats.count = int(stored['count'])
+            stats.mean = stored['mean']
+            stats.m2 = stored['m2']
+            stats.min = stored['min']
+            stats.max = stored['max']
+        return stats
+
+
+def load_stats(paths):
+    """ Loads and merges the statistics files of several feature directories. """
+    stats = FeatureStats()
+    for path in paths:
+        stats.merge(FeatureStats.load(path))
+    return stats
+
+
+class ShardWriter:
+    """ Appends feature arrays of many items to a few large contiguous files. """
+
+    def __init__(self, path, dtype='float16', shard_frames=2 ** 20, append=False):
+        """ Args:
+                path (string): Feature directory, the store goes to path/shards.
+                dtype (string): 'float16' or 'float32'.
+                shard_frames (int): Frames per shard file before starting a new one.
+                append (bool): Keep the items of an existing store with the same dtype and
+                    write new ones to new shard files. Rewritten items leave their old
+                    frames unreferenced.
+        """
+        self.path = os.path.join(path, SHARD_DIR)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.dtype = np.dtype(dtype)
+        self.shard_frames = shard_frames
+        self.n_features = None
+        self.shards = []
+        self.items = {}
+        self._file = None
+        self._frames = 0
+        index_path = os.path.join(self.path, SHARD_INDEX)
+        if append and os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if np.dtype(index['dtype']) == self.dtype:
+                self.n_features = index['n_features']
+                self.shards = index['shards']
+                self.items = index['items']
+
+    def append(self, item_id, data):
+        data = np.asarray(data)
+        if self.n_features is None:
+            self.n_features = data.shape[1]
+        elif data.shape[1] != self.n_features:
+            raise ValueError('{}: {} features, store has {}'.format(item_id, data.shape[1], self.n_features))
+        if self._file is None or self._frames >= self.shard_frames:
+            self._next_shard()
+        self.items[item_id] = [len(self.shards) - 1, self._frames, data.shape[0]]
+        data.astype(self.dtype).tofile(self._file)
+        self._frames += data.shape[0]
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = 'shard_{:03d}.bin'.format(len(self.shards))
+        self.shards.append(name)
+        self._file = open(os.path.join(self.path, name), 'wb')
+        self._frames = 0
+
+    def flush(self):
+        """ Makes every item appended so far readable, the index is replaced atomically. """
+        if self._file is not None:
+            self._file.flush()
+        tmp = os.path.join(self.path, SHARD_INDEX + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'dtype': self.dtype.name, 'n_features': self.n_features,
+                       'shards': self.shards, 'items': self.items}, f)
+        os.replace(tmp, os.path.join(self.path, SHARD_INDEX))
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ShardReader:
+    """ Random access to a shard store through np.memmap, get returns a zero-copy view. """
+
+    def __init__(self, path):
+        path = os.path.join(path, SHARD_DIR)
+        with open(os.path.join(path, SHARD_INDEX), 'r') as f:
+            index = json.load(f)
+        self.items = index['items']
+        self.dtype = np.dtype(index['dtype'])
+        self.n_features = index['n_features']
+        self.shards = []
+        for name in index['shards']:
+            size = os.path.getsize(os.path.join(path, name)) // (self.dtype.itemsize * self.n_features)
+            if size == 0:
+                self.shards.append(np.zeros((0, self.n_features), dtype=self.dtype))
+                continue
+            self.shards.append(np.memmap(os.path.join(path, name), dtype=self.dtype, mode='r',
+                                         shape=(size, self.n_features)))
+
+    def __contains__(self, item_id):
+        return item_id in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def frames(self, item_id):
+        return self.items[item_id][2]
+
+    def get(self, item_id):
+        shard, offset, frames = self.items[item_id]
+        return self.shards[shard][offset:offset + frames]
+
+
+class ShardSet:
+    """ Shard stores of several feature directories under a common root.
+        Item ids are '<directory>/<name>' as in the filelists, the store of each
+        directory is opened on first use.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.readers = {}
+
+    def get(self, file_id):
+        directory, name = os.path.split(file_id)
+        if directory not in self.readers:
+            self.readers[directory] = ShardReader(os.path.join(self.root, directory))
+        return self.readers[directory].get(name)
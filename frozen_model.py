@@ -0,0 +1,201 @@
+import json
+import numpy as np
+
+# NumPy runtime of the models exported by export.py: BatchNormalization is
+# folded in the weights and the graph is a fixed list of operations, so
+# scoring needs neither Keras nor TensorFlow.
+
+# ---- EXPORTED FILE (.npz) ---- #
+#   graph : JSON list of operations {'op', ...parameters}
+#   l<n>_W, l<n>_b : float32 weights of operation n
+#   l<n>_Wq, l<n>_Wscale : int8 weights and per output channel scale (int8 export)
+#   l<n>_in_scale : calibrated int8 step of the inputs of operation n (int8 export)
+WEIGHT_OPS = ('conv', 'depthwise', 'dense')
+# ------------------------------ #
+
+
+def _pad_same(x, kernel, strides):
+    pads = [(0, 0)]
+    for size, k, s in zip(x.shape[1:3], kernel, strides):
+        out = -(-size // s)
+        total = max((out - 1) * s + k - size, 0)
+        pads.append((total // 2, total - total // 2))
+    return np.pad(x, pads + [(0, 0)], mode='constant')
+
+
+def conv2d(x, W, b, strides=(1, 1), padding='valid'):
+    """ channels_last 2D convolution as matrix products over the kernel taps. """
+    kh, kw = W.shape[:2]
+    sh, sw = strides
+    if padding == 'same':
+        x = _pad_same(x, (kh, kw), strides)
+    out_h = (x.shape[1] - kh) // sh + 1
+    out_w = (x.shape[2] - kw) // sw + 1
+    taps = [x[:, i:i + sh * (out_h - 1) + 1:sh, j:j + sw * (out_w - 1) + 1:sw]
+            for i in range(kh) for j in range(kw)]
+    if kh * kw * x.shape[3] <= 64:
+        # few input channels (first layer): one product over all the taps
+        out = np.matmul(np.concatenate(taps, axis=-1), W.reshape(-1, W.shape[3]))
+    else:
+        out = np.zeros((x.shape[0], out_h, out_w, W.shape[3]), dtype=np.float32)
+        for tap, w in zip(taps, W.reshape(kh * kw, W.shape[2], W.shape[3])):
+            out += np.matmul(tap, w)
+    if b is not None:
+        out += b
+    return out
+
+
+def depthwise_conv2d(x, W, b=None, strides=(1, 1), padding='valid'):
+    """ channels_last depthwise convolution, W of shape (kh, kw, channels,
+        depth_multiplier) as Keras DepthwiseConv2D (output channel c * m + k).
+    """
+    kh, kw, channels, multiplier = W.shape
+    sh, sw = strides
+    if padding == 'same':
+        x = _pad_same(x, (kh, kw), strides)
+    out_h = (x.shape[1] - kh) // sh + 1
+    out_w = (x.shape[2] - kw) // sw + 1
+    out = np.zeros((x.shape[0], out_h, out_w, channels, multiplier), dtype=np.float32)
+    for i in range(kh):
+        for j in range(kw):
+            out += x[:, i:i + sh * (out_h - 1) + 1:sh, j:j + sw * (out_w - 1) + 1:sw, :, None] * W[i, j]
+    out = out.reshape(out.shape[:3] + (channels * multiplier,))
+    if b is not None:
+        out += b
+    return out
+
+
+def pool2d(x, pool, strides, padding='valid', reduce=np.max):
+    ph, pw = pool
+    sh, sw = strides
+    if padding == 'same':
+        x = _pad_same(x, pool, strides)
+    if (sh, sw) == (ph, pw):
+        h, w = x.shape[1] // ph, x.shape[2] // pw
+        x = x[:, :h * ph, :w * pw].reshape(x.shape[0], h, ph, w, pw, x.shape[3])
+        return reduce(reduce(x, axis=4), axis=2)
+    out_h = (x.shape[1] - ph) // sh + 1
+    out_w = (x.shape[2] - pw) // sw + 1
+    taps = [x[:, i:i + sh * (out_h - 1) + 1:sh, j:j + sw * (out_w - 1) + 1:sw]
+            for i in range(ph) for j in range(pw)]
+    return reduce(np.stack(taps), axis=0)
+
+
+def activation(x, name, alpha=0.0):
+    if name == 'linear':
+        return x
+    if name == 'sigmoid':
+        return 1.0 / (1.0 + np.exp(-x))
+    if name == 'relu':
+        return np.maximum(x, 0)
+    if name == 'leaky_relu':
+        return np.maximum(x, alpha * x) if alpha <= 1 else np.where(x > 0, x, alpha * x)
+    if name == 'tanh':
+        return np.tanh(x)
+    raise ValueError('Unknown activation {}'.format(name))
+
+
+def fake_quantize(x, scale):
+    """ Rounds x to the int8 grid of step scale, as an int8 input would be. """
+    return np.clip(np.round(x / scale), -127, 127) * scale
+
+
+class FrozenModel:
+    """ Inference of an exported model on (batch, frames, features, 1) arrays.
+        Has the predict and predict_on_batch methods used by predict.py and detect.py.
+    """
+
+    def __init__(self, ops, input_shape=None):
+        self.ops = ops
+        self.input_shape = input_shape
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            spec = json.loads(str(stored['graph']))
+            ops = []
+            for n, op in enumerate(spec['ops']):
+                op = dict(op)
+                prefix = 'l{}_'.format(n)
+                if prefix + 'Wq' in stored.files:
+                    # int8 weights, dequantized once for the float matrix products
+                    op['W'] = stored[prefix + 'Wq'].astype(np.float32) * stored[prefix + 'Wscale']
+                elif prefix + 'W' in stored.files:
+                    op['W'] = stored[prefix + 'W']
+                if prefix + 'b' in stored.files:
+                    op['b'] = stored[prefix + 'b']
+                if prefix + 'in_scale' in stored.files:
+                    op['in_scale'] = float(stored[prefix + 'in_scale'])
+                ops.append(op)
+        return cls(ops, tuple(spec['input_shape']))
+
+    def run(self, x, observe=None):
+        """ Runs the operations on a batch. observe(n, inputs) is called
+            before every weighted operation (calibration).
+        """
+        x = np.asarray(x, dtype=np.float32)
+        for n, op in enumerate(self.ops):
+            kind = op['op']
+            if kind in WEIGHT_OPS:
+                if observe is not None:
+                    observe(n, x)
+                if 'in_scale' in op:
+                    x = fake_quantize(x, op['in_scale'])
+            if kind == 'conv':
+                x = activation(conv2d(x, op['W'], op.get('b'), op['strides'], op['padding']), op['activation'])
+            elif kind == 'depthwise':
+                x = activation(depthwise_conv2d(x, op['W'], op.get('b'), op['strides'], op['padding']),
+                               op['activation'])
+            elif kind == 'dense':
+                x = activation(np.dot(x, op['W']) + op.get('b', 0), op['activation'])
+            elif kind == 'affine':
+                x = x * op['W'] + op['b']
+            elif kind == 'activation':
+                x = activation(x, op['activation'], op.get('alpha', 0.0))
+            elif kind == 'maxpool':
+                x = pool2d(x, op['pool'], op['strides'], op['padding'], np.max)
+            elif kind == 'avgpool':
+                x = pool2d(x, op['pool'], op['strides'], op['padding'], np.mean)
+            elif kind == 'flatten':
+                x = x.reshape(len(x), -1)
+            elif kind == 'global_avgpool':
+                x = x.mean(axis=(1, 2))
+            elif kind == 'global_maxpool':
+                x = x.max(axis=(1, 2))
+            else:
+                raise ValueError('Unknown operation {}'.format(kind))
+        return x
+
+    def predict_on_batch(self, x):
+        return self.run(x)
+
+    def predict(self, x, batch_size=32):
+        return np.concatenate([self.run(x[n:n + batch_size]) for n in range(0, len(x), batch_size)])
+
+    def save(self, path):
+        arrays = {}
+        spec = []
+        for n, op in enumerate(self.ops):
+            prefix = 'l{}_'.format(n)
+            params = {}
+            for key, value in op.items():
+                if key in ('W', 'b', 'Wq', 'Wscale', 'in_scale'):
+                    arrays[prefix + key] = np.asarray(value, dtype=np.int8 if key == 'Wq' else np.float32)
+                else:
+                    params[key] = value
+            if 'Wq' in op:
+                arrays.pop(prefix + 'W', None)
+            spec.append(params)
+        arrays['graph'] = np.array(json.dumps({'ops': spec, 'input_shape': list(self.input_shape)}))
+        np.savez(path, **arrays)
+
+
+def load_model(path, weights=None):
+    """ Loads an exported .npz model, or a Keras .h5 model (and weights by name). """
+    if path.endswith('.npz'):
+        return FrozenModel.load(path)
+    from keras.models import load_model as load_keras_model
+    model = load_keras_model(path, compile=False)
+    if weights is not None:
+        model.load_weights(weights, by_name=True)
+    return model
@@ -0,0 +1,300 @@
+import os
+import argparse
+import numpy as np
+from scipy.io import wavfile
+from HTK import HTKFile
+
+# In-process replacement of HTK HCopy for MFCC / FBANK / MELSPEC extraction.
+# Follows the HTK Book chapter 5 (HSigP / HParm) algorithms so the output is
+# numerically close to the files written by the HCopy binary.
+
+# ---- CONFIG DEFAULTS (HTK) ---- #
+DEFAULTS = {'TARGETKIND': 'MFCC',
+            'TARGETRATE': 100000.0,
+            'WINDOWSIZE': 256000.0,
+            'USEHAMMING': True,
+            'PREEMCOEF': 0.97,
+            'NUMCHANS': 20,
+            'NUMCEPS': 12,
+            'CEPLIFTER': 22,
+            'LOFREQ': -1.0,
+            'HIFREQ': -1.0,
+            'USEPOWER': False,
+            'ZMEANSOURCE': False,
+            'RAWENERGY': True,
+            'ENORMALISE': True,
+            'ESCALE': 0.1,
+            'SILFLOOR': 50.0,
+            'DELTAWINDOW': 2,
+            'ACCWINDOW': 2,
+            'SAVECOMPRESSED': False,
+            }
+# ------------------------------- #
+
+
+def read_config(path):
+    """ Reads an HCopy configuration file into a dict of typed values.
+        Lines look like "KEY = VALUE" with an optional "MODULE:" prefix, '#' starts a comment.
+    """
+    config = dict(DEFAULTS)
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if '=' not in line:
+                continue
+            key, value = [field.strip() for field in line.split('=', 1)]
+            key = key.split(':')[-1].strip().upper()
+            value = value.strip('"\'')
+            if value.upper() in ('T', 'TRUE'):
+                config[key] = True
+            elif value.upper() in ('F', 'FALSE'):
+                config[key] = False
+            else:
+                try:
+                    config[key] = float(value) if '.' in value or 'E' in value.upper() else int(value)
+                except ValueError:
+                    config[key] = value
+    return config
+
+
+def read_wav(path):
+    """ Reads a wav file with the sample scale used by HTK (16-bit integer values). """
+    fs, x = wavfile.read(path)
+    if x.ndim > 1:
+        x = x.mean(axis=1)
+    if x.dtype.kind == 'f':
+        x = x * 32768.0
+    elif x.dtype == np.int32:
+        x = x / 65536.0
+    elif x.dtype == np.uint8:
+        x = (x.astype(np.float64) - 128.0) * 256.0
+    return x.astype(np.float64), fs
+
+
+def _mel(f):
+    return 1127.0 * np.log(1.0 + f / 700.0)
+
+
+def _regression(feat, window):
+    """ HTK delta regression over time (axis 0) with replicated edges. """
+    n = feat.shape[0]
+    padded = np.concatenate([np.repeat(feat[:1], window, axis=0), feat,
+                             np.repeat(feat[-1:], window, axis=0)])
+    delta = np.zeros_like(feat)
+    for theta in range(1, window + 1):
+        delta += theta * (padded[window + theta:window + theta + n] - padded[window - theta:window - theta + n])
+    return delta / (2.0 * sum(theta * theta for theta in range(1, window + 1)))
+
+
+class HTKFeatures:
+    """ HCopy compatible feature extractor working on in-memory signals.
+        The analysis window, FFT filterbank and DCT matrix are computed once per sample rate.
+    """
+
+    def __init__(self, config):
+        """ Args:
+                config (dict or string): HCopy configuration dict or path to the configuration file.
+        """
+        if not isinstance(config, dict):
+            config = read_config(config)
+        else:
+            config = dict(DEFAULTS, **config)
+        self.config = config
+        fields = str(config['TARGETKIND']).upper().split('_')
+        self.basicKind = fields[0]
+        self.qualifiers = fields[1:]
+        if self.basicKind not in ('MFCC', 'FBANK', 'MELSPEC'):
+            raise NotImplementedError('TARGETKIND {} is not implemented'.format(config['TARGETKIND']))
+        self._cache = {}
+
+    @property
+    def kind(self):
+        """ Parameter kind of the output frames, as written in the HTK header. """
+        return '_'.join([self.basicKind] + self.qualifiers)
+
+    @property
+    def sampPeriod(self):
+        return int(self.config['TARGETRATE'])
+
+    def _setup(self, fs):
+        if fs in self._cache:
+            return self._cache[fs]
+        c = self.config
+        period = 1.0e7 / fs
+        frame_size = int(c['WINDOWSIZE'] / period + 1e-6)
+        frame_rate = int(c['TARGETRATE'] / period + 1e-6)
+        fft_n = 2
+        while fft_n < frame_size:
+            fft_n *= 2
+        n_by2 = fft_n // 2
+        num_chans = int(c['NUMCHANS'])
+
+        if c['USEHAMMING']:
+            window = 0.54 - 0.46 * np.cos(2 * np.pi * np.arange(frame_size) / (frame_size - 1))
+        else:
+            window = np.ones(frame_size)
+
+        # Mel filterbank (HParm InitFBank), k is the 1-based spectrum index
+        fres = 1.0e7 / (period * fft_n * 700.0)
+        klo, khi = 2, n_by2
+        mlo, mhi = 0.0, 1127.0 * np.log(1.0 + n_by2 * fres)
+        if c['LOFREQ'] >= 0:
+            mlo = _mel(c['LOFREQ'])
+            klo = max(int(c['LOFREQ'] * period * 1.0e-7 * fft_n + 2.5), 2)
+        if c['HIFREQ'] >= 0:
+            mhi = _mel(c['HIFREQ'])
+            khi = min(int(c['HIFREQ'] * period * 1.0e-7 * fft_n + 0.5), n_by2)
+        cf = mlo + (mhi - mlo) * np.arange(num_chans + 2) / (num_chans + 1.0)
+        cf[0] = mlo
+        fbank = np.zeros((n_by2 + 1, num_chans))
+        for k in range(klo, khi + 1):
+            melk = 1127.0 * np.log(1.0 + (k - 1) * fres)
+            chan = int(np.searchsorted(cf[1:], melk, side='left')) + 1
+            lo_chan = chan - 1
+            if lo_chan > 0:
+                lo_wt = (cf[lo_chan + 1] - melk) / (cf[lo_chan + 1] - cf[lo_chan])
+                fbank[k - 1, lo_chan - 1] += lo_wt
+            else:
+                lo_wt = (cf[1] - melk) / (cf[1] - mlo)
+            if lo_chan < num_chans:
+                fbank[k - 1, lo_chan] += 1.0 - lo_wt
+
+        # DCT and liftering (HSigP FBankToMFCC / WeightCepstrum)
+        num_ceps = int(c['NUMCEPS'])
+        j = np.arange(1, num_ceps + 1)[:, np.newaxis]
+        k = np.arange(1, num_chans + 1)[np.newaxis, :]
+        dct = np.sqrt(2.0 / num_chans) * np.cos(np.pi * j / num_chans * (k - 0.5))
+        lifter = int(c['CEPLIFTER'])
+        if lifter > 0:
+            dct *= (1.0 + lifter / 2.0 * np.sin(np.arange(1, num_ceps + 1) * np.pi / lifter))[:, np.newaxis]
+
+        setup = {'frame_size': frame_size, 'frame_rate': frame_rate, 'fft_n': fft_n,
+                 'window': window, 'fbank': fbank, 'dct': dct.T}
+        self._cache[fs] = setup
+        return setup
+
+    def _frames(self, x, setup):
+        frame_size, frame_rate = setup['frame_size'], setup['frame_rate']
+        n_frames = max((len(x) - frame_size) // frame_rate + 1, 0)
+        index = np.arange(frame_size)[np.newaxis, :] + frame_rate * np.arange(n_frames)[:, np.newaxis]
+        return x[index]
+
+    def _static(self, frames, setup):
+        """ Computes static parameters and raw log energies for a stack of frames. """
+        c = self.config
+        frames = np.array(frames, dtype=np.float64)
+        if c['ZMEANSOURCE']:
+            frames -= frames.mean(axis=1, keepdims=True)
+        if c['RAWENERGY']:
+            energy = np.sum(frames ** 2, axis=1)
+        k = c['PREEMCOEF']
+        if k > 0:
+            frames[:, 1:] -= k * frames[:, :-1].copy()
+            frames[:, 0] *= 1.0 - k
+        frames *= setup['window']
+        if not c['RAWENERGY']:
+            energy = np.sum(frames ** 2, axis=1)
+        log_energy = np.where(energy < 2.45e-308, -1.0e10, np.log(np.maximum(energy, 2.45e-308)))
+
+        spec = np.abs(np.fft.rfft(frames, n=setup['fft_n'], axis=1))
+        if c['USEPOWER']:
+            spec = spec ** 2
+        fbank = np.dot(spec, setup['fbank'])
+        if self.basicKind == 'MELSPEC':
+            return fbank, log_energy
+        fbank = np.log(np.maximum(fbank, 1.0))
+        if self.basicKind == 'FBANK':
+            return fbank, log_energy
+
+        static = np.dot(fbank, setup['dct'])
+        if '0' in self.qualifiers:
+            c0 = np.sqrt(2.0 / fbank.shape[1]) * np.sum(fbank, axis=1)
+            static = np.hstack([static, c0[:, np.newaxis]])
+        return static, log_energy
+
+    def _finish(self, static, log_energy):
+        """ Per utterance stage: energy normalisation, mean removal and derivatives. """
+        c = self.config
+        if 'Z' in self.qualifiers:
+            static = static - static.mean(axis=0)
+        if 'E' in self.qualifiers:
+            if c['ENORMALISE'] and len(log_energy) > 0:
+                e_max = np.max(log_energy)
+                e_min = e_max - c['SILFLOOR'] * np.log(10.0) / 10.0
+                log_energy = 1.0 - (e_max - np.maximum(log_energy, e_min)) * c['ESCALE']
+            static = np.hstack([static, log_energy[:, np.newaxis]])
+
+        feat = [static]
+        if 'D' in self.qualifiers or 'A' in self.qualifiers or 'T' in self.qualifiers:
+            feat.append(_regression(static, int(c['DELTAWINDOW'])))
+        if 'A' in self.qualifiers or 'T' in self.qualifiers:
+            feat.append(_regression(feat[-1], int(c['ACCWINDOW'])))
+        if 'T' in self.qualifiers:
+            feat.append(_regression(feat[-1], int(c['ACCWINDOW'])))
+        if 'N' in self.qualifiers and 'E' in self.qualifiers:
+            feat[0] = feat[0][:, :-1]
+        return np.hstack(feat).astype(np.float32)
+
+    def compute(self, x, fs):
+        """ Computes the features of one signal.
+            Args:
+                x (ndarray): Samples with 16-bit integer scale (see read_wav).
+                fs (int): Sample rate.
+            Returns:
+                ndarray: float32 frames with shape (nFrames, nFeatures).
+        """
+        return self.compute_batch([x], fs)[0]
+
+    def compute_batch(self, signals, fs):
+        """ Computes the features of several signals sharing a sample rate.
+            The frames of every signal go through a single FFT and filterbank product.
+        """
+        setup = self._setup(fs)
+        frames = [self._frames(np.asarray(x, dtype=np.float64), setup) for x in signals]
+        counts = np.cumsum([len(f) for f in frames])[:-1]
+        static, log_energy = self._static(np.concatenate(frames), setup)
+        return [self._finish(s, e) for s, e in zip(np.split(static, counts), np.split(log_energy, counts))]
+
+    def convert(self, wav, htk=None):
+        """ Equivalent of HTK.HCopy: computes the features of a wav file and optionally saves them.
+            Returns:
+                ndarray: float32 frames.
+        """
+        x, fs = read_wav(wav)
+        data = self.compute(x, fs)
+        if htk is not None:
+            HTKFile().save(htk, data, self.sampPeriod, self.kind, compressed=self.config['SAVECOMPRESSED'])
+        return data
+
+
+def main():
+    parser = argparse.ArgumentParser('In-process HCopy')
+    parser.add_argument('config', help='HCopy configuration file')
+    parser.add_argument('input', help='Directory with .wav files')
+    parser.add_argument('output', help='Directory to save the HTK files')
+    parser.add_argument('--ext', default='.mfc', help='Extension of the HTK files')
+    parser.add_argument('--reference', default=None,
+                        help='Directory with HCopy outputs to compare against')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    extractor = HTKFeatures(args.config)
+    worst = 0.0
+    for wave in sorted(os.listdir(args.input)):
+        if not wave.lower().endswith('.wav'):
+            continue
+        name = os.path.splitext(wave)[0] + args.ext
+        data = extractor.convert(os.path.join(args.input, wave), os.path.join(args.output, name))
+        if args.reference is not None:
+            reference = HTKFile().load(os.path.join(args.reference, name))
+            n = min(len(reference), len(data))
+            error = np.max(np.abs(reference[:n] - data[:n])) if n else 0.0
+            worst = max(worst, error)
+            print('{}: frames {}/{} max abs diff {:.5f}'.format(name, len(data), len(reference), error))
+    if args.reference is not None:
+        print('Worst max abs diff: {:.5f}'.format(worst))
+
+
+if __name__ == '__main__':
+    main()
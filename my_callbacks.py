@@ -1,8 +1,14 @@
 # from keras callbacks examples : https://github.com/keunwoochoi/keras_callbacks_example
 
+import time
+import logging
+import numpy as np
 import keras
+from keras import backend as K
 from sklearn.metrics import roc_auc_score
 
+logger = logging.getLogger(__name__)
+
 class Histories(keras.callbacks.Callback):
 	def on_train_begin(self, logs={}):
 		self.aucs = []
@@ -16,12 +22,99 @@ class Histories(keras.callbacks.Callback):
 
 	def on_epoch_end(self, epoch, logs={}):
 		self.losses.append(logs.get('loss'))
-		y_pred = self.model.predict(self.validation_data[0])
-		self.aucs.append(roc_auc_score(self.validation_data[1], y_pred))
+		# computed by ValidationMetrics, fit_generator gives no validation_data
+		self.aucs.append(logs.get('val_auc'))
 		return
 
 	def on_batch_begin(self, batch, logs={}):
 		return
 
 	def on_batch_end(self, batch, logs={}):
-		return
\ No newline at end of file
+		return
+
+
+class StreamingAUC:
+	""" Exact ROC AUC of predictions added batch by batch. Only the labels
+		and float32 scores are kept (5 bytes per item), a histogram would
+		count the pairs of saturated sigmoid scores sharing a bin as ties.
+	"""
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.labels = []
+		self.scores = []
+
+	def update(self, y_true, y_score):
+		self.labels.append(np.asarray(y_true).reshape(-1) > 0.5)
+		self.scores.append(np.asarray(y_score, dtype=np.float32).reshape(-1))
+
+	def result(self):
+		labels = np.concatenate(self.labels) if self.labels else np.zeros(0, dtype=bool)
+		if labels.all() or not labels.any():
+			return float('nan')
+		return float(roc_auc_score(labels, np.concatenate(self.scores)))
+
+
+class ValidationMetrics(keras.callbacks.Callback):
+	""" Validation pass of fit_generator done batch by batch at the end of
+		every epoch: val_loss, val_acc, val_auc and val_auc_<dataset> (the
+		directory of the item ids, e.g. val_auc_warblrb10k) are added to the
+		logs, with val_time the duration of the pass. val_loss includes the
+		regularization losses of the model as the one of Keras.
+		Replaces the validation of fit_generator (do not give it
+		validation_data as well) and must come before the callbacks reading
+		these logs (ModelCheckpoint monitor='val_auc', ReduceLROnPlateau, CSVLogger).
+	"""
+
+	def __init__(self, loader, batches=None):
+		""" Args:
+				loader (DataLoader): Validation loader, labelled ('val' mode).
+				batches (Prefetcher): Iterator over the batches of loader, optional.
+		"""
+		super(ValidationMetrics, self).__init__()
+		self.loader = loader
+		self.batches = batches
+
+	def on_epoch_end(self, epoch, logs={}):
+		start = time.time()
+		overall = StreamingAUC()
+		datasets = {}
+		loss = 0.0
+		correct = 0
+		count = 0
+		for idx in range(len(self.loader)):
+			if self.batches is not None:
+				x, y = next(self.batches)
+				items = self.batches.items
+			else:
+				x, y = self.loader[idx]
+				items = self.loader.batch_items(idx)
+			# the loader returns ([inputs], [labels]), the Prefetcher arrays
+			y = np.asarray(y[0] if isinstance(y, list) else y).reshape(-1)
+			y_pred = np.asarray(self.model.predict_on_batch(x), dtype=np.float64).reshape(-1)
+			p = np.clip(y_pred, 1e-7, 1 - 1e-7)
+			loss -= np.sum(y * np.log(p) + (1 - y) * np.log(1 - p))
+			correct += np.sum((y_pred > 0.5) == (y > 0.5))
+			count += len(y)
+			overall.update(y, y_pred)
+			names = np.array([file_id.split('/')[0] for file_id, _ in items])
+			for name in np.unique(names):
+				if name not in datasets:
+					datasets[name] = StreamingAUC()
+				datasets[name].update(y[names == name], y_pred[names == name])
+		if self.batches is None:
+			self.loader.on_epoch_end()
+
+		# l2 penalties of the weights, as in the val_loss of fit_generator
+		penalty = sum(float(K.eval(l)) for l in self.model.losses)
+		logs['val_loss'] = float(loss) / max(count, 1) + penalty
+		logs['val_acc'] = float(correct) / max(count, 1)
+		logs['val_auc'] = overall.result()
+		for name in sorted(datasets):
+			logs['val_auc_' + name] = datasets[name].result()
+		logs['val_time'] = time.time() - start
+		logger.info('Epoch {} validation: {} items in {:.1f} s, AUC {:.4f} ({})'.format(
+			epoch + 1, count, logs['val_time'], logs['val_auc'],
+			', '.join('{} {:.4f}'.format(name, logs['val_auc_' + name]) for name in sorted(datasets))))
@@ -0,0 +1,162 @@
+import os
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+from preprocess_signal import define_param, extract_features, options_hash
+
+# Feature extraction at training time ('wav' features in birddet_baseline.py),
+# the results are kept in a size bounded LRU cache.
+
+
+class LRUCache:
+    """ Least recently used cache of arrays bounded in bytes.
+        With disk_dir, items evicted from RAM are spilled to .npy files, the
+        disk tier is an LRU bounded by disk_bytes too.
+    """
+
+    def __init__(self, ram_bytes, disk_dir=None, disk_bytes=None):
+        self.ram_bytes = ram_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.ram = OrderedDict()
+        self.disk = OrderedDict()
+        self.ram_used = 0
+        self.disk_used = 0
+        self.hits = 0
+        self.misses = 0
+        if disk_dir is not None:
+            if not os.path.isdir(disk_dir):
+                os.makedirs(disk_dir)
+            # Files spilled by a previous run are reused
+            for name in sorted(os.listdir(disk_dir)):
+                if name.endswith('.npy'):
+                    path = os.path.join(disk_dir, name)
+                    self.disk[name[:-4]] = os.path.getsize(path)
+                    self.disk_used += self.disk[name[:-4]]
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.npy')
+
+    def __contains__(self, key):
+        return key in self.ram or key in self.disk
+
+    def get(self, key):
+        """ Returns the cached array or None. """
+        if key in self.ram:
+            self.ram.move_to_end(key)
+            self.hits += 1
+            return self.ram[key]
+        if key in self.disk:
+            self.disk.move_to_end(key)
+            self.hits += 1
+            data = np.load(self._disk_path(key))
+            self._put_ram(key, data)
+            return data
+        self.misses += 1
+        return None
+
+    def put(self, key, data):
+        self._put_ram(key, data)
+
+    def _put_ram(self, key, data):
+        if key in self.ram:
+            self.ram_used -= self.ram.pop(key).nbytes
+        self.ram[key] = data
+        self.ram_used += data.nbytes
+        while self.ram_used > self.ram_bytes and len(self.ram) > 1:
+            old_key, old = self.ram.popitem(last=False)
+            self.ram_used -= old.nbytes
+            self._spill(old_key, old)
+
+    def _spill(self, key, data):
+        if self.disk_dir is None or key in self.disk:
+            return
+        np.save(self._disk_path(key), data)
+        self.disk[key] = os.path.getsize(self._disk_path(key))
+        self.disk_used += self.disk[key]
+        while self.disk_bytes is not None and self.disk_used > self.disk_bytes and len(self.disk) > 1:
+            old_key, size = self.disk.popitem(last=False)
+            self.disk_used -= size
+            os.remove(self._disk_path(old_key))
+
+
+def _extract(job):
+    # Pool worker
+    path, options, spec_type, norm = job
+    return extract_features(path, options, spec_type, norm).astype(np.float32)
+
+
+class OnlineFeatures:
+    """ Computes the features of filelist items from their wavs on a pool of
+        background processes.
+        prefetch submits the upcoming items so they are ready when get asks
+        for them, computed features are kept in an LRUCache across epochs.
+    """
+
+    def __init__(self, wav_path, process='frequential', spec_type='mel',
+                 norm=None, workers=2, cache=None):
+        """ Args:
+                wav_path (string): Root of the wavs, items are '<dataset>/<name>.wav'.
+                process (string): define_param option set.
+                spec_type (string): 'mel' or 'normal'.
+                norm (string): None or 'individual', as in preprocess_signal.py.
+                workers (int): Number of background processes, 0 computes in the caller.
+                cache (LRUCache): Cache of the computed features, defaults to 1 GB of RAM.
+        """
+        self.wav_path = wav_path
+        self.options = define_param(process)
+        self.spec_type = spec_type
+        self.norm = norm
+        self.cache = cache if cache is not None else LRUCache(2 ** 30)
+        self.pending = {}
+        # prefetch and get can be called from several loader threads
+        self._lock = threading.Lock()
+        self.pool = multiprocessing.Pool(workers) if workers > 0 else None
+        self._hash = options_hash(spec_type, self.options, norm, None, None)
+
+    def _key(self, file_id):
+        # size and mtime of the wav, so a replaced wav misses the disk cache of earlier runs
+        try:
+            st = os.stat(os.path.join(self.wav_path, file_id))
+            source = '{}:{}:{}'.format(file_id, st.st_size, st.st_mtime)
+        except OSError:
+            source = file_id
+        return hashlib.sha1((self._hash + source).encode()).hexdigest()
+
+    def _job(self, file_id):
+        return (os.path.join(self.wav_path, file_id), self.options,
+                self.spec_type, self.norm)
+
+    def prefetch(self, file_ids):
+        """ Starts computing the items that are neither cached nor pending. """
+        if self.pool is None:
+            return
+        with self._lock:
+            for file_id in file_ids:
+                key = self._key(file_id)
+                if key not in self.pending and key not in self.cache:
+                    self.pending[key] = self.pool.apply_async(_extract, (self._job(file_id),))
+
+    def get(self, file_id):
+        """ Returns the features of one item, computing them if needed. """
+        key = self._key(file_id)
+        with self._lock:
+            data = self.cache.get(key)
+            pending = self.pending.pop(key, None)
+        if data is not None:
+            return data
+        if pending is not None:
+            data = pending.get()
+        else:
+            data = _extract(self._job(file_id))
+        with self._lock:
+            self.cache.put(key, data)
+        return data
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
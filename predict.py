@@ -0,0 +1,186 @@
+import os
+import csv
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from frozen_model import load_model
+from data_loader import DataLoader, FeatureReader
+from feature_store import load_stats, ShardReader
+from online_features import OnlineFeatures, LRUCache
+
+# Batch inference without the training script: the model is loaded once and
+# the items are streamed in batches, the rows of every batch are appended to
+# the CSV before the next one is read, so memory does not grow with the
+# number of items.
+
+# ---- INPUT FILES ---- #
+#   extension of the feature files of each features type, the item id is
+#   the path without it ('mfc' items get '.wav' back as in the filelists).
+#   'shard' inputs are feature directories, their items come from the shard index
+FEATURE_EXT = {'npy': '.npy', 'npz': '.npz', 'h5': '.h5', 'mfc': '.mfc', 'wav': '.wav'}
+# --------------------- #
+
+
+def _input_id(path, features):
+    if features == 'mfc':
+        return path[:-len('.mfc')] + '.wav'
+    if features == 'wav':
+        return path
+    return path[:-len(FEATURE_EXT[features])]
+
+
+def iter_items(inputs, features, filelist=None):
+    """ Yields (file_id, itemid) of the items to score.
+        Filelist ids are relative to the feature root and get the itemid of
+        the submission files (name after the dataset directory, last
+        extension removed). Files and directories given as inputs get their
+        wav name as itemid. With 'shard' features the inputs are feature
+        directories and every item of their shard store is scored.
+    """
+    if filelist is not None:
+        with open(filelist, 'r') as f:
+            for line in f:
+                file_id = line.rstrip()
+                if file_id:
+                    yield file_id, file_id[file_id.find('/') + 1:-4]
+    if features == 'shard':
+        for path in inputs:
+            for name in sorted(ShardReader(path).items):
+                yield os.path.join(path, name), name
+        return
+    ext = FEATURE_EXT[features]
+    for path in inputs:
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path) if name.endswith(ext))
+            paths = (os.path.join(path, name) for name in names)
+        else:
+            paths = [path]
+        for file_path in paths:
+            file_id = _input_id(file_path, features)
+            yield file_id, os.path.basename(file_id)
+
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def predict(model, reader, items, output, batch_size=256, expected_shape=(1000, 180),
+            feature_stats=None, norm_mode='none', norm_method='minmax', dtype='float32',
+            mfc_suffix=4, append=False):
+    """ Scores items and writes the 'itemid,prediction' CSV as it goes.
+        The next batch is prepared on a thread while the model runs, into
+        one of two reused buffers, and the last batch holds only the
+        remaining items.
+        Args:
+            model: Keras model (or anything with predict_on_batch).
+            reader (FeatureReader): Loads the features of an item.
+            items (iterable): (file_id, itemid) pairs, e.g. from iter_items.
+            output (string): CSV file.
+            append (bool): Append to an existing CSV instead of rewriting it with a header.
+        Returns:
+            int: Number of scored items.
+    """
+    loader_args = dict(expected_shape=expected_shape, feature_stats=feature_stats,
+                       norm_mode=norm_mode, norm_method=norm_method, dtype=dtype,
+                       mfc_suffix=mfc_suffix)
+    shape = (batch_size, expected_shape[0], expected_shape[1], 1)
+    buffers = [(np.zeros(shape, dtype=dtype), np.zeros((batch_size, 1), dtype=np.float32))
+               for _ in range(2)]
+
+    def fill(chunk, buffer):
+        loader = DataLoader([file_id for file_id, _ in chunk], reader, 'test', batch_size, **loader_args)
+        return chunk, loader.fill_batch(0, *buffer)[0]
+
+    count = 0
+    pool = ThreadPoolExecutor(1)
+    with open(output, 'a' if append else 'w', newline='') as f:
+        writer = csv.writer(f)
+        if not append:
+            writer.writerow(['itemid', 'prediction'])
+        chunks = iter_chunks(items, batch_size)
+        pending = None
+        for n, chunk in enumerate(chunks):
+            # features computed from wavs start in the background now
+            reader.prefetch([file_id for file_id, _ in chunk])
+            future = pool.submit(fill, chunk, buffers[n % 2])
+            if pending is not None:
+                count += _score(model, writer, *pending.result())
+                f.flush()
+            pending = future
+        if pending is not None:
+            count += _score(model, writer, *pending.result())
+    pool.shutdown()
+    return count
+
+
+def _score(model, writer, chunk, batch):
+    y_pred = np.asarray(model.predict_on_batch(batch)).reshape(len(chunk), -1)[:, 0]
+    writer.writerows((itemid, float(p)) for (_, itemid), p in zip(chunk, y_pred))
+    return len(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score feature files or wavs with a trained model')
+    parser.add_argument('model', help='Keras model (.h5) or exported model (.npz)')
+    parser.add_argument('inputs', nargs='*',
+                        help='Feature files or directories (shard stores with --features shard)')
+    parser.add_argument('--weights', default=None, help='Weights loaded by name after the model')
+    parser.add_argument('--filelist', default=None,
+                        help='Filelist of item ids relative to --spect-path, as the test filelists')
+    parser.add_argument('--output', default='predictions.csv', help='Submission CSV')
+    parser.add_argument('--append', action='store_true', help='Append rows to an existing CSV')
+    parser.add_argument('--features', default='npy', choices=['npy', 'npz', 'shard', 'mfc', 'h5', 'wav'])
+    parser.add_argument('--spect-path', default='',
+                        help='Root of the feature files (or wavs) of the filelist')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--frames', type=int, default=1000,
+                        help='Frames per item when the model accepts any length')
+    parser.add_argument('--norm-stats', nargs='*', default=None,
+                        help='Statistics files for the global/bin normalization')
+    parser.add_argument('--norm-mode', default='none', choices=['none', 'global', 'bin'])
+    parser.add_argument('--norm-method', default='minmax', choices=['minmax', 'standard'])
+    parser.add_argument('--max-value', type=float, default=0)
+    parser.add_argument('--min-value', type=float, default=0)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--process', default='frequential',
+                        help='define_param option set of the wav features')
+    parser.add_argument('--type', default='mel', choices=['normal', 'mel'])
+    parser.add_argument('--norm', default='individual', choices=['none', 'individual'])
+    parser.add_argument('--workers', type=int, default=4, help='Processes computing wav features')
+    args = parser.parse_args()
+    if (args.filelist is None) == (not args.inputs):
+        parser.error('give either --filelist or input files')
+
+    model = load_model(args.model, args.weights)
+    _, frames, n_features, _ = model.input_shape
+    expected_shape = (frames or args.frames, n_features)
+
+    online_features = None
+    if args.features == 'wav':
+        online_features = OnlineFeatures(args.spect_path, args.process, args.type,
+                                         None if args.norm == 'none' else args.norm,
+                                         args.workers, LRUCache(2 ** 28))
+    reader = FeatureReader(args.spect_path, args.features, args.max_value, args.min_value, online_features)
+    feature_stats = load_stats(args.norm_stats) if args.norm_stats else None
+
+    start = time.time()
+    count = predict(model, reader, iter_items(args.inputs, args.features, args.filelist), args.output,
+                    args.batch_size, expected_shape, feature_stats, args.norm_mode, args.norm_method,
+                    args.dtype, 8 if args.filelist is not None else 4, args.append)
+    elapsed = time.time() - start
+    if online_features is not None:
+        online_features.close()
+    print('{} items in {:.1f} s ({:.1f} items/s), predictions in {}'.format(
+        count, elapsed, count / max(elapsed, 1e-9), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 
 #SBATCH -p veu # Partition to submit to
 #SBATCH --mem=2G      # Max CPU Memory
+#SBATCH --cpus-per-task=8
 #SBATCH --error=logs/preprocess/error_20_10_180_f_norm.log
 #SBATCH --output=logs/preprocess/20_10_180_f_norm.log
 
@@ -10,6 +11,7 @@ output_path="/home/usuaris/veu/llorenc.sole/bird_detect/workingfiles/features_hi
 type_spectro="mel"
 process="frequential"
 norm="individual"
+workers=8
 
 source env.env
-python ./preprocess_signal.py $input_path $output_path --type $type_spectro --process $process --norm $norm
+python ./preprocess_signal.py $input_path $output_path --type $type_spectro --process $process --norm $norm --workers $workers
@@ -2,8 +2,17 @@ import librosa
 import librosa.display
 import argparse
 import os
+import sys
+import json
+import hashlib
+import multiprocessing
 import numpy as np
+from scipy import sparse
 import matplotlib.pyplot as plt
+from audio_io import (read_audio, resample, load_audio, PCMCache, audio_info,
+                      stream_audio, stream_resample)
+from feature_store import (save_features, load_features, fit_to_shape,
+                           FeatureStats, ShardWriter, ShardReader)
 
 # ---- OPTIONS TAMPLATE ----- #
 #    dic = {'FS': 22050,
@@ -19,6 +28,12 @@ import matplotlib.pyplot as plt
 #           }
 # --------------------------- #
 
+# Statistics saved next to the features of every output directory
+STATS_FILE = 'stats.npz'
+# Manifest of the processed files of every output directory
+MANIFEST_FILE = 'manifest.jsonl'
+
+
 # Parameters for the transformation
 def define_param(option):
     dic = {'FS': 22050,
@@ -47,50 +62,270 @@ def define_param(option):
         return dic
 
 
-def compute_spectrogram(path, options):
-    x, fs = librosa.load(path)
-    # Resample
-    if fs != options['FS']:
-        x = librosa.resample(x, fs, options['FS'])
+def load_signal(path):
+    # Decode at the native rate of the file, resampled later per options
+    return read_audio(path)
+
+
+def resample_signal(x, fs, target_fs):
+    # Polyphase resample, only if the rates differ
+    return resample(x, fs, target_fs)
+
+
+def stft_key(options):
+    # Options producing the same STFT share this key
+    fs = options['FS']
+    return (fs, options['N_FFT'], int(options['HOP_t']*fs),
+            int(options['WIN_t']*fs), options['WIN'])
+
+
+def power_to_db(S, amin=1e-10, top_db=80.0):
+    # librosa.power_to_db (ref=1) with top_db applied per clip (last 2 axes)
+    log_spec = 10.0 * np.log10(np.maximum(amin, S))
+    if top_db is None:
+        return log_spec
+    peak = np.amax(log_spec, axis=(-2, -1), keepdims=True)
+    return np.maximum(log_spec, peak - top_db)
+
+
+class MelFrontend:
+    """ Spectrogram front end for one define_param option set.
+        The analysis window and a sparse mel matrix are built once, and
+        signals can be a single clip (samples,) or a stack of equal length
+        clips (clips, samples) processed with one batched FFT and matmul.
+        All outputs use the (frames, bins) layout saved by this tool.
+    """
+
+    def __init__(self, options, pad_mode='reflect'):
+        self.options = options
+        self.pad_mode = pad_mode
         fs = options['FS']
-    # Compute sfft
-    sfft_spec = librosa.core.stft(x, n_fft=options['N_FFT'],
-                                  hop_length=int(options['HOP_t']*fs),
-                                  win_length=int(options['WIN_t']*fs),
-                                  window=options['WIN'])
+        self.n_fft = options['N_FFT']
+        self.hop = int(options['HOP_t']*fs)
+        self.win_length = int(options['WIN_t']*fs)
+        # Window samples inside the centred n_fft frame (librosa pad_center)
+        self.offset = (self.n_fft - self.win_length) // 2
+        self.window = librosa.filters.get_window(
+            options['WIN'], self.win_length, fftbins=True).astype(np.float32)
+        self.mel_basis = sparse.csr_matrix(
+            librosa.filters.mel(sr=fs, n_fft=self.n_fft,
+                                n_mels=options['N_MEL'],
+                                fmin=options['F_MIN'],
+                                fmax=options['F_MAX']))
+
+    def stft(self, x):
+        """ Centred STFT with shape (..., frames, 1 + N_FFT/2).
+            Only the win_length non zero samples of each frame are read, so
+            the phase is referenced to the window start (magnitudes match
+            librosa.stft).
+        """
+        x = np.asarray(x, dtype=np.float32)
+        pad = [(0, 0)] * (x.ndim - 1) + [(self.n_fft // 2, self.n_fft // 2)]
+        x = np.pad(x, pad, mode=self.pad_mode)
+        n_frames = 1 + (x.shape[-1] - self.n_fft) // self.hop
+        starts = self.offset + self.hop * np.arange(n_frames)
+        frames = x[..., starts[:, np.newaxis] + np.arange(self.win_length)]
+        return np.fft.rfft(frames * self.window, n=self.n_fft, axis=-1)
+
+    def power(self, x):
+        return np.abs(self.stft(x))**2
+
+    def mel(self, power):
+        # Sparse projection of a power spectrum (..., frames, freq)
+        flat = power.reshape(-1, power.shape[-1])
+        mel = self.mel_basis.dot(flat.T).T
+        return mel.reshape(power.shape[:-1] + (mel.shape[-1],))
+
+    def log_mel(self, power, top_db=80.0):
+        return power_to_db(self.mel(power), top_db=top_db).astype(np.float32)
+
+    def __call__(self, x):
+        """ Log mel spectrogram (..., frames, N_MEL) of one or more clips. """
+        return self.log_mel(self.power(x))
+
+    def n_frames(self, n_samples):
+        # Frames of the centred STFT of a signal with n_samples
+        return 1 + (n_samples + 2 * (self.n_fft // 2) - self.n_fft) // self.hop
+
+    def stream(self, blocks, mel=True):
+        """ Yields the frames of a signal given as an iterable of sample blocks.
+            The STFT overlap is carried between blocks, so the concatenated
+            output equals the one-shot result before the top_db clipping,
+            which needs the global peak (see save_spectrogram_stream).
+            Memory is bounded by the block size and one analysis frame.
+            pad_mode must only need the samples near each edge ('reflect',
+            'symmetric', 'edge' or 'constant').
+        """
+        if self.pad_mode not in ('reflect', 'symmetric', 'edge', 'constant'):
+            raise ValueError('pad_mode {} can not be streamed'.format(self.pad_mode))
+        half = self.n_fft // 2
+        buf = np.zeros(0, dtype=np.float32)
+        buf_start = 0
+        frame = 0
+        padded = False
+        for block in blocks:
+            buf = np.concatenate([buf, np.asarray(block, dtype=np.float32)])
+            if not padded:
+                if len(buf) <= half:
+                    continue
+                # Padding of the signal start
+                buf = np.pad(buf, (half, 0), mode=self.pad_mode)
+                padded = True
+            frame, buf, buf_start, out = self._stream_frames(
+                buf, buf_start, frame, mel)
+            if out is not None:
+                yield out
+        if len(buf) == 0:
+            return
+        if not padded:
+            buf = np.pad(buf, (half, 0), mode=self.pad_mode)
+        # Padding of the signal end, buf keeps at least half + 1 samples
+        buf = np.pad(buf, (0, half), mode=self.pad_mode)
+        frame, buf, buf_start, out = self._stream_frames(buf, buf_start,
+                                                         frame, mel)
+        if out is not None:
+            yield out
+
+    def _stream_frames(self, buf, buf_start, frame, mel):
+        # Frames fully inside buf (padded coordinates start at buf_start)
+        n_frames = (buf_start + len(buf) - self.n_fft) // self.hop + 1 - frame
+        out = None
+        if n_frames > 0:
+            starts = self.hop * (frame + np.arange(n_frames)) + self.offset \
+                - buf_start
+            frames = buf[starts[:, np.newaxis] + np.arange(self.win_length)]
+            power = np.abs(np.fft.rfft(frames * self.window, n=self.n_fft,
+                                       axis=-1))**2
+            if mel:
+                out = self.log_mel(power, top_db=None)
+            else:
+                out = power_to_db(power, top_db=None).astype(np.float32)
+            frame += n_frames
+        # Keep the next frame and the samples for the end padding
+        keep = min(self.hop * frame, buf_start + len(buf) - self.n_fft // 2 - 1)
+        keep = max(keep, buf_start)
+        return frame, buf[keep - buf_start:], keep, out
+
+
+_frontends = {}
+
+
+def get_frontend(options):
+    # MelFrontend cached per process for each distinct option set
+    key = stft_key(options) + (options['N_MEL'], options['F_MIN'],
+                               options['F_MAX'])
+    if key not in _frontends:
+        _frontends[key] = MelFrontend(options)
+    return _frontends[key]
+
+
+def compute_stft(x, options):
+    # Compute sfft, (frames, freq)
+    return get_frontend(options).stft(x)
+
+
+def spectrogram_from_stft(sfft_spec, options):
     # Log Spectogram
-    lfeat = librosa.core.power_to_db(np.abs(sfft_spec)**2)
-    # Convert to an array
-    lfeat = np.array(lfeat)
+    return power_to_db(np.abs(sfft_spec)**2).astype(np.float32)
+
 
-    return lfeat.transpose()
+def mel_from_stft(sfft_spec, options):
+    # Log Mel Spectrogram from the power spectrum
+    return get_frontend(options).log_mel(np.abs(sfft_spec)**2)
+
+
+def compute_spectrogram(path, options):
+    x = load_audio(path, options['FS'])
+    return spectrogram_from_stft(compute_stft(x, options), options)
 
 
 def compute_spectrogram_mel(path, options):
-    x, fs = librosa.load(path)
-    # Resample
-    if fs != options['FS']:
-        x = librosa.resample(x, fs, options['FS'])
-        fs = options['FS']
-    # Compute sfft
-    # N_FFT = int(len(x) / 2)
-    sfft_spec = librosa.core.stft(x, n_fft=options['N_FFT'],
-                                  hop_length=int(options['HOP_t']*fs),
-                                  win_length=int(options['WIN_t']*fs),
-                                  window=options['WIN'])
-    # Create Mel filter
-    mel_filter = librosa.filters.mel(fs, n_fft=options['N_FFT'],
-                                     n_mels=options['N_MEL'],
-                                     fmin=options['F_MIN'],
-                                     fmax=options['F_MAX'])
-    # Filtering
-    mel_feat = np.dot(mel_filter, sfft_spec)
-    # Log Mel Spectrogram
-    lmel_feat = librosa.core.power_to_db(np.abs(mel_feat)**2)
-    # Convert to an array
-    lmel_feat = np.array(lmel_feat)
-
-    return lmel_feat.transpose()
+    x = load_audio(path, options['FS'])
+    return get_frontend(options)(x)
+
+
+def stream_spectrogram(path, options, spec_type='mel', blocksize=2 ** 18):
+    """ Yields the (frames, bins) log spectrogram of a recording of any length,
+        block by block, without the top_db clipping.
+    """
+    _, fs = audio_info(path)
+    blocks = stream_resample(stream_audio(path, blocksize), fs, options['FS'])
+    return get_frontend(options).stream(blocks, mel=spec_type == 'mel')
+
+
+def save_spectrogram_stream(path, output_file, options, spec_type='mel',
+                            blocksize=2 ** 18, top_db=80.0):
+    """ Writes the spectrogram of a long recording straight to a .npy memmap.
+        Peak memory is a few blocks whatever the length of the recording.
+        The top_db clipping is applied in a final pass over the memmap, so
+        the file equals the one-shot compute_spectrogram(_mel) result.
+    """
+    frontend = get_frontend(options)
+    n_samples, fs = audio_info(path)
+    n_samples = -(-n_samples * int(options['FS']) // int(fs))
+    n_bins = options['N_MEL'] if spec_type == 'mel' \
+        else frontend.n_fft // 2 + 1
+    out = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float32,
+                                    shape=(frontend.n_frames(n_samples),
+                                           n_bins))
+    pos = 0
+    peak = -np.inf
+    for frames in stream_spectrogram(path, options, spec_type, blocksize):
+        out[pos:pos + len(frames)] = frames
+        peak = max(peak, np.amax(frames))
+        pos += len(frames)
+    if top_db is not None:
+        for n in range(0, len(out), blocksize):
+            np.maximum(out[n:n + blocksize], peak - top_db,
+                       out=out[n:n + blocksize])
+    out.flush()
+    return out
+
+
+def compute_features(paths, outputs, cache=None):
+    """ Computes several feature sets of several wavs in a single pass.
+        Each file is decoded at most once and resampled once per rate, or
+        read from the PCM cache. Signals with the same length are stacked,
+        so every option set with the same stft_key shares one batched STFT.
+        Returns, for each path, the list of features in the order of outputs.
+    """
+    decoded = {}
+
+    def signal(n, rate):
+        if cache is not None:
+            x = cache.get(paths[n], rate)
+            if x is not None:
+                return x
+        if n not in decoded:
+            decoded[n] = load_signal(paths[n])
+        x = resample_signal(decoded[n][0], decoded[n][1], rate)
+        if cache is not None:
+            cache.put(paths[n], rate, x)
+        return x
+
+    results = [[None] * len(outputs) for path in paths]
+    for rate in set(options['FS'] for _, options in outputs):
+        groups = {}
+        for n in range(len(paths)):
+            x = signal(n, rate)
+            groups.setdefault(len(x), []).append((n, x))
+        for group in groups.values():
+            index = [n for n, _ in group]
+            batch = np.stack([x for _, x in group])
+            stfts = {}
+            for o, (spec_type, options) in enumerate(outputs):
+                if options['FS'] != rate:
+                    continue
+                key = stft_key(options)
+                if key not in stfts:
+                    stfts[key] = compute_stft(batch, options)
+                if spec_type == 'normal':
+                    features = spectrogram_from_stft(stfts[key], options)
+                elif spec_type == 'mel':
+                    features = mel_from_stft(stfts[key], options)
+                for n, feat in zip(index, features):
+                    results[n][o] = feat
+    return results
 
 
 def normalization(data):
@@ -102,8 +337,9 @@ def normalization(data):
     return norm_data
 
 
-def save_spectogram(data, path, name):
-    np.save(os.path.join(path, name), data)
+def save_spectogram(data, path, name, compress=None):
+    # compress: None/'none' -> .npy, 'int16' or 'uint8' -> quantized .npz
+    save_features(os.path.join(path, name), data, compress)
 
 
 def plot_spectogram(data, options):
@@ -126,44 +362,326 @@ def plot_spectogram_mel(data, options):
     plt.show()
 
 
+def finish_features(features, options, norm=None):
+    """ Normalizes and cuts the features to expected_len frames. With the
+        'fit' option shorter ones are fitted too, so the training
+        generators get them in expected shape.
+    """
+    # Normalization
+    if norm == 'individual':
+        features = normalization(features)
+
+    if len(features) > options['expected_len']:
+        features = np.resize(features, (options['expected_len'],
+                                        options['N_MEL']))
+    # Short clips, fitted as the training generators do
+    if options.get('fit'):
+        features = fit_to_shape(features, (options['expected_len'],
+                                           features.shape[1]))
+    return features
+
+
+def extract_features(path, options, spec_type='mel', norm=None):
+    """ Features of one wav as saved by this tool (normalized and cut). """
+    if spec_type == 'normal':
+        features = compute_spectrogram(path, options)
+    else:
+        features = compute_spectrogram_mel(path, options)
+    return finish_features(features, options, norm)
+
+
+def process_file(job):
+    """ Computes, normalizes and saves every requested feature set of a
+        chunk of wavs.
+        Returns one FeatureStats per output with the statistics of the saved
+        features of the chunk and, with the shard store, one list of
+        (name, features) per output to be packed by the parent process.
+    """
+    file_paths, outputs, norm, compress, shards, pcm_cache = job
+    cache = PCMCache(pcm_cache) if pcm_cache else None
+    all_features = compute_features(file_paths, [(spec_type, options)
+                                                 for _, spec_type, options
+                                                 in outputs], cache)
+    stats = [FeatureStats() for output in outputs]
+    packed = [[] for output in outputs]
+    for file_path, file_features in zip(file_paths, all_features):
+        for n, ((output_path, spec_type, options), features) in enumerate(
+                zip(outputs, file_features)):
+            features = finish_features(features, options, norm)
+            name = os.path.basename(file_path)
+            if shards is None:
+                save_spectogram(features, output_path, name, compress)
+            else:
+                packed[n].append((name, features.astype(shards)))
+            stats[n].update(features)
+    return stats, packed
+
+
+def options_hash(spec_type, options, norm, compress, shards):
+    # Everything that changes the saved features of one output
+    params = dict(options, type=spec_type, norm=norm, compress=compress,
+                  shards=shards)
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def manifest_entry(file_path, opt_hash):
+    st = os.stat(file_path)
+    return {'name': os.path.basename(file_path),
+            'source': os.path.abspath(file_path),
+            'size': st.st_size, 'mtime': st.st_mtime, 'options': opt_hash}
+
+
+def load_manifest(output_path):
+    """ Reads the manifest of an output directory as a dict name -> entry.
+        Later lines override earlier ones, a line cut by a crash is ignored.
+    """
+    entries = {}
+    path = os.path.join(output_path, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[entry['name']] = entry
+    return entries
+
+
+def append_manifest(output_path, entries):
+    with open(os.path.join(output_path, MANIFEST_FILE), 'a') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+        f.flush()
+
+
+def save_manifest(output_path, entries):
+    # Compact the manifest to one line per output file
+    path = os.path.join(output_path, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        for name in sorted(entries):
+            f.write(json.dumps(entries[name]) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def load_saved(output_path, name, compress, reader=None):
+    # Features written by a previous run, for the statistics
+    if reader is not None:
+        return reader.get(name)
+    if compress in (None, 'none'):
+        return load_features(os.path.join(output_path, name + '.npy'))
+    return load_features(os.path.join(output_path, name + '.npz'))
+
+
+def stats_fingerprint(entry):
+    # Manifest fields identifying the features counted in a statistics file
+    return [entry['size'], entry['mtime'], entry['options']]
+
+
+def load_previous_stats(output_path, manifest, fresh):
+    """ Statistics file of a previous run and the names of the files it
+        covers. It is reused only if every covered file is still fresh with
+        the same manifest entry: the frames of a removed or rewritten file
+        can not be taken out of min and max.
+    """
+    path = os.path.join(output_path, STATS_FILE)
+    if not os.path.exists(path):
+        return FeatureStats(), set()
+    with np.load(path) as stored:
+        if 'items' not in stored.files:
+            return FeatureStats(), set()
+        items = json.loads(str(stored['items']))
+    fresh = set(fresh)
+    if any(name not in fresh or stats_fingerprint(manifest[name]) != value
+           for name, value in items.items()):
+        return FeatureStats(), set()
+    return FeatureStats.load(path), set(items)
+
+
+def preprocess_directory(input_path, outputs, norm=None, compress=None,
+                         workers=1, batch=4, shards=None, pcm_cache=None,
+                         force=False, flush_chunks=64):
+    """ Runs process_file over the new or modified files of input_path.
+        outputs is a list of (output_path, spec_type, options).
+        Every output directory keeps a manifest with the source path,
+        size/mtime and options hash of its files. Files whose entries match
+        in all the outputs are skipped unless force is set, and the manifest
+        is appended as chunks finish so a killed run resumes where it
+        stopped.
+        Files are grouped in chunks of batch wavs that share the STFT calls.
+        With workers > 1 the chunks are dispatched to a process pool, the
+        output names and the merged statistics are the same as the serial run.
+        If shards is a dtype ('float16' or 'float32') the features are packed
+        in a shard store of each output directory instead of one file per
+        wav, its index is flushed every flush_chunks chunks.
+        pcm_cache is an optional directory keeping the decoded PCM for reruns.
+        Returns one FeatureStats per output, covering skipped files too, and
+        saves it in the STATS_FILE of the output with the files it covers.
+        The statistics of the skipped files come from the previous
+        STATS_FILE, saved features are only read back when it does not
+        cover them (first run of an older directory, removed or rewritten
+        files).
+    """
+    hashes = [options_hash(spec_type, options, norm, compress, shards)
+              for _, spec_type, options in outputs]
+    manifests = []
+    for output_path, _, _ in outputs:
+        if force and os.path.exists(os.path.join(output_path, MANIFEST_FILE)):
+            os.remove(os.path.join(output_path, MANIFEST_FILE))
+        manifests.append(load_manifest(output_path))
+
+    waves = []
+    fresh = []
+    for wave in sorted(os.listdir(input_path)):
+        file_path = os.path.join(input_path, wave)
+        if all(manifest.get(wave) == manifest_entry(file_path, opt_hash)
+               for manifest, opt_hash in zip(manifests, hashes)):
+            fresh.append(wave)
+        else:
+            waves.append(file_path)
+
+    jobs = [(waves[n:n + batch], outputs, norm, compress, shards, pcm_cache)
+            for n in range(0, len(waves), batch)]
+    stats = [FeatureStats() for output in outputs]
+    writers = None
+    if shards is not None:
+        writers = [ShardWriter(output_path, shards, append=not force)
+                   for output_path, _, _ in outputs]
+    pending = [[] for output in outputs]
+
+    def flush():
+        for n, (output_path, _, _) in enumerate(outputs):
+            if writers is not None:
+                writers[n].flush()
+            append_manifest(output_path, pending[n])
+            for entry in pending[n]:
+                manifests[n][entry['name']] = entry
+            pending[n] = []
+
+    def collect(index, chunk, job):
+        chunk_stats, packed = chunk
+        for n in range(len(outputs)):
+            stats[n].merge(chunk_stats[n])
+            if writers is not None:
+                for name, features in packed[n]:
+                    writers[n].append(name, features)
+            pending[n].extend(manifest_entry(file_path, hashes[n])
+                              for file_path in job[0])
+        if writers is None or (index + 1) % flush_chunks == 0:
+            flush()
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for index, (chunk, job) in enumerate(
+                    zip(pool.imap(process_file, jobs), jobs)):
+                collect(index, chunk, job)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for index, job in enumerate(jobs):
+            collect(index, process_file(job), job)
+
+    if writers is not None:
+        for writer in writers:
+            writer.close()
+    flush()
+
+    # Statistics of the skipped files, from the previous statistics file
+    # or else from their saved features
+    processed = [os.path.basename(file_path) for file_path in waves]
+    for n, (output_path, _, _) in enumerate(outputs):
+        previous, covered = load_previous_stats(output_path, manifests[n], fresh)
+        stats[n].merge(previous)
+        missing = [name for name in fresh if name not in covered]
+        reader = ShardReader(output_path) if shards is not None and missing \
+            else None
+        for name in missing:
+            stats[n].update(load_saved(output_path, name, compress, reader))
+        save_manifest(output_path, manifests[n])
+        items = dict((name, stats_fingerprint(manifests[n][name]))
+                     for name in fresh + processed)
+        stats[n].save(os.path.join(output_path, STATS_FILE),
+                      items=np.array(json.dumps(items)))
+    return stats
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Pre processing Signal Tool")
     parser.add_argument('input_file', help='Path with the .vaw files')
-    parser.add_argument('output_file', help='Path to save the spectograms')
-    parser.add_argument('--type', choices=['normal', 'mel'],
+    parser.add_argument('output_file', help='Path to save the spectograms. '
+                        'With several types/processes a <process>_<type> '
+                        'subdirectory is used for each one')
+    parser.add_argument('--type', choices=['normal', 'mel'], nargs='+',
                         help='Compute with Mel Coef or simple spectogram')
     parser.add_argument('--process', choices=['baseline', 'temporal',
-                                              'frequential'],
+                                              'frequential'], nargs='+',
                         help='Choose type of process signal')
     parser.add_argument('--norm', choices=['none', 'individual', 'full'],
-                        help='Choose the normalization of the signal')
+                        help='Choose the normalization of the signal. With '
+                        'full the features are saved as they are and the '
+                        'training generators normalize them with the '
+                        'statistics file')
+    parser.add_argument('--compress', choices=['none', 'int16', 'uint8'],
+                        default='none',
+                        help='Store quantized features (.npz) instead of .npy')
+    parser.add_argument('--shards', choices=['float16', 'float32'],
+                        default=None,
+                        help='Pack the features in memory-mappable shards '
+                        'of this dtype instead of one file per wav')
+    parser.add_argument('--pcm-cache', default=None,
+                        help='Directory to cache the decoded and resampled '
+                        'audio between runs')
+    parser.add_argument('--fit', action='store_true',
+                        help='Fit short clips to expected_len frames as the '
+                        'training generators do, so they skip it')
+    parser.add_argument('--force', action='store_true',
+                        help='Recompute every file, ignoring the manifest')
+    parser.add_argument('--stream', action='store_true',
+                        help='Long recordings: compute each file block by '
+                        'block into a memory-mapped .npy, bounded memory')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes computing the features')
+    parser.add_argument('--batch', type=int, default=4,
+                        help='Wavs per batched STFT call')
     args = parser.parse_args()
 
-    options = define_param(args.process)
-    max_value = 0
-    min_value = 0
-    for wave in os.listdir(args.input_file):
-        file_path = os.path.join(args.input_file, wave)
-        if args.type == 'normal':
-            features = compute_spectrogram(file_path, options)
-        elif args.type == 'mel':
-            features = compute_spectrogram_mel(file_path, options)
-        # Normalization
-        if args.norm == 'individual':
-            features = normalization(features)
-
-        elif args.norm == 'full':
-            if np.amax(features) > max_value:
-                max_value = np.amax(features)
-            if np.amin(features) < min_value:
-                min_value = np.amin(features)
-
-        if len(features) > options['expected_len']:
-            features = np.resize(features, (options['expected_len'],
-                                            options['N_MEL']))
-        # elif len(features) < expected_len:
-        # TODO: Complete
-        save_spectogram(features, args.output_file, wave)
-
-    print('Max Value: {}'.format(max_value))
-    print('Min Value: {}'.format(min_value))
+    outputs = []
+    for process in args.process:
+        for spec_type in args.type:
+            if len(args.process) * len(args.type) == 1:
+                output_path = args.output_file
+            else:
+                output_path = os.path.join(args.output_file,
+                                           process + '_' + spec_type)
+                if not os.path.isdir(output_path):
+                    os.makedirs(output_path)
+            options = define_param(process)
+            if args.fit:
+                options['fit'] = True
+            outputs.append((output_path, spec_type, options))
+
+    if args.stream:
+        # One recording at a time, features are not normalized nor resized
+        for wave in sorted(os.listdir(args.input_file)):
+            for output_path, spec_type, options in outputs:
+                save_spectrogram_stream(
+                    os.path.join(args.input_file, wave),
+                    os.path.join(output_path, wave + '.npy'), options,
+                    spec_type)
+        sys.exit(0)
+
+    stats = preprocess_directory(args.input_file, outputs, args.norm,
+                                 args.compress, args.workers, args.batch,
+                                 args.shards, args.pcm_cache, args.force)
+
+    # Statistics files (STATS_FILE) are used by the training generators
+    # ('full' normalization)
+    for (output_path, _, _), output_stats in zip(outputs, stats):
+        if len(outputs) > 1:
+            print(output_path)
+        max_value = np.amax(output_stats.max) if output_stats.count else 0
+        min_value = np.amin(output_stats.min) if output_stats.count else 0
+        print('Max Value: {}'.format(max_value))
+        print('Min Value: {}'.format(min_value))
@@ -0,0 +1,135 @@
+import time
+import argparse
+import numpy as np
+from architectures import ARCHITECTURES, build_model
+
+# Cost of the registered architectures (architectures.py): FLOPs, parameters
+# and activation memory of every layer from its shapes, and CPU latency
+# measured layer by layer, to weigh against the AUC of each one.
+
+
+def _elements(shape):
+    return int(np.prod(shape[1:]))
+
+
+def layer_flops(layer):
+    """ Floating point operations of one clip through a layer (a multiply-add
+        counts 2), from its configuration and input/output shapes.
+    """
+    kind = layer.__class__.__name__
+    config = layer.get_config()
+    in_shape, out_shape = layer.input_shape, layer.output_shape
+    out = _elements(out_shape)
+    if kind == 'Conv2D':
+        kh, kw = config['kernel_size']
+        flops = 2 * out * kh * kw * in_shape[-1]
+    elif kind == 'DepthwiseConv2D':
+        kh, kw = config['kernel_size']
+        flops = 2 * out * kh * kw
+    elif kind == 'SeparableConv2D':
+        kh, kw = config['kernel_size']
+        depth = in_shape[-1] * config['depth_multiplier']
+        positions = out // out_shape[-1]
+        flops = 2 * positions * depth * (kh * kw + out_shape[-1])
+    elif kind == 'Dense':
+        flops = 2 * out * in_shape[-1]
+    elif kind == 'BatchNormalization':
+        return 2 * out
+    elif kind in ('LeakyReLU', 'Activation', 'ReLU'):
+        return out
+    elif kind in ('MaxPooling2D', 'AveragePooling2D'):
+        return out * int(np.prod(config['pool_size']))
+    elif kind in ('GlobalAveragePooling2D', 'GlobalMaxPooling2D'):
+        return _elements(in_shape)
+    else:
+        return 0
+    if config.get('use_bias'):
+        flops += out
+    if config.get('activation', 'linear') != 'linear':
+        flops += out
+    return flops
+
+
+def profile_layers(model, batch_size=1, bytes_per_value=4):
+    """ Returns:
+            list: One dict per layer with name, kind, output shape, params,
+                flops (per clip) and activation bytes (output of the batch).
+    """
+    return [{'name': layer.name, 'kind': layer.__class__.__name__,
+             'shape': tuple(layer.output_shape[1:]), 'params': layer.count_params(),
+             'flops': layer_flops(layer),
+             'bytes': batch_size * _elements(layer.output_shape) * bytes_per_value}
+            for layer in model.layers]
+
+
+def _median_time(function, repeat):
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def layer_latency(model, batch, repeat=5):
+    """ CPU seconds of every layer on a batch: each prefix of the model is
+        timed up to a layer and the layer gets the difference with the
+        previous prefix (noisy for the cheapest layers).
+    """
+    from keras import backend as K
+    totals = []
+    for layer in model.layers:
+        function = K.function([model.input], [layer.output])
+        function([batch])
+        totals.append(_median_time(lambda: function([batch]), repeat))
+    return np.maximum(np.diff([0.0] + totals), 0.0), totals[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FLOPs, parameters, memory and latency of the architectures')
+    parser.add_argument('architectures', nargs='*', default=sorted(ARCHITECTURES),
+                        help='Names from architectures.py, all of them by default')
+    parser.add_argument('--pooling', default=None, choices=['flatten', 'global'],
+                        help='Head pooling, the architecture default if not given')
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--bins', type=int, default=180)
+    parser.add_argument('--batch-size', type=int, default=16, help='Batch of the latency measure')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions, median time is reported')
+    parser.add_argument('--no-latency', action='store_true', help='Only the computed costs')
+    args = parser.parse_args()
+
+    from keras import backend as K
+    # inference graph: Dropout off, BatchNormalization with the moving statistics
+    K.set_learning_phase(0)
+    batch = np.random.RandomState(0).rand(args.batch_size, args.frames, args.bins, 1).astype(np.float32)
+
+    summary = []
+    for name in args.architectures:
+        model = build_model(name, (args.frames, args.bins, 1), args.pooling)
+        layers = profile_layers(model, args.batch_size)
+        latency, total = (np.zeros(len(layers)), 0.0) if args.no_latency else \
+            layer_latency(model, batch, args.repeat)
+
+        print('\n{} ({} frames x {} bins, batch of {})'.format(name, args.frames, args.bins, args.batch_size))
+        print('{:28s} {:22s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+            'layer', 'output', 'params', 'MFLOPs', 'act. MB', 'ms/clip'))
+        for layer, seconds in zip(layers, latency):
+            print('{:28s} {:22s} {:10d} {:10.2f} {:10.2f} {:10.3f}'.format(
+                '{} ({})'.format(layer['name'], layer['kind'])[:28], str(layer['shape']), layer['params'],
+                layer['flops'] / 1e6, layer['bytes'] / 2 ** 20, seconds * 1000 / args.batch_size))
+        # the largest input + output pair alive at once
+        sizes = [batch.nbytes] + [layer['bytes'] for layer in layers]
+        summary.append((name, model.count_params(), sum(layer['flops'] for layer in layers) / 1e6,
+                        max(a + b for a, b in zip(sizes[:-1], sizes[1:])) / 2 ** 20,
+                        total * 1000 / args.batch_size))
+        K.clear_session()
+        K.set_learning_phase(0)
+
+    print('\n{:16s} {:>10s} {:>12s} {:>14s} {:>10s}'.format('architecture', 'params', 'MFLOPs/clip',
+                                                          'peak act. MB', 'ms/clip'))
+    for row in summary:
+        print('{:16s} {:10d} {:12.1f} {:14.1f} {:10.3f}'.format(*row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import os
+import bisect
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Cache of the finished input tensors of the data loaders (loaded, fitted
+# and normalized items), shared by the train, validation and test loaders
+# so the epochs after the first one do not read and prepare them again.
+
+
+class TensorCache:
+    """ Least recently used cache of item tensors with a RAM budget.
+        Items evicted from RAM are spilled to one preallocated np.memmap file
+        (first fit allocation, least recently used spilled items are dropped
+        when it is full). Items are stored as dtype, float16 halves the
+        memory of float32 tensors.
+        The cache is thread safe but is not shared between processes, use it
+        with threads (use_multiprocessing=False) in fit_generator.
+    """
+
+    def __init__(self, ram_bytes, spill_path=None, spill_bytes=0, dtype='float16'):
+        """ Args:
+                ram_bytes (int): Memory budget of the tensors kept in RAM.
+                spill_path (string): Memmap file for the items evicted from RAM, None disables it.
+                spill_bytes (int): Size of the spill file.
+                dtype (string): 'float16' or 'float32'.
+        """
+        self.ram_bytes = ram_bytes
+        self.dtype = np.dtype(dtype)
+        self.ram = OrderedDict()
+        self.ram_used = 0
+        self.spilled = OrderedDict()
+        self.spill = None
+        self.free = []
+        if spill_path is not None and spill_bytes >= self.dtype.itemsize:
+            directory = os.path.dirname(spill_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            size = spill_bytes // self.dtype.itemsize
+            self.spill = np.memmap(spill_path, dtype=self.dtype, mode='w+', shape=(size,))
+            # free extents (start, size), sorted by start
+            self.free = [(0, size)]
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.ram or key in self.spilled
+
+    def __len__(self):
+        return len(self.ram) + len(self.spilled)
+
+    def get(self, key):
+        """ Returns the cached tensor or None. """
+        with self._lock:
+            if key in self.ram:
+                self.ram.move_to_end(key)
+                self.hits += 1
+                return self.ram[key]
+            if key in self.spilled:
+                start, shape = self.spilled.pop(key)
+                size = int(np.prod(shape))
+                data = np.array(self.spill[start:start + size]).reshape(shape)
+                self._release(start, size)
+                self.hits += 1
+                self._put_ram(key, data)
+                return data
+            self.misses += 1
+            return None
+
+    def put(self, key, data):
+        """ Stores a tensor, returns it as stored (dtype). """
+        data = np.asarray(data, dtype=self.dtype)
+        with self._lock:
+            if key in self.spilled:
+                start, shape = self.spilled.pop(key)
+                self._release(start, int(np.prod(shape)))
+            self._put_ram(key, data)
+        return data
+
+    def _put_ram(self, key, data):
+        if key in self.ram:
+            self.ram_used -= self.ram.pop(key).nbytes
+        self.ram[key] = data
+        self.ram_used += data.nbytes
+        while self.ram_used > self.ram_bytes and len(self.ram) > 1:
+            old_key, old = self.ram.popitem(last=False)
+            self.ram_used -= old.nbytes
+            self._spill(old_key, old)
+
+    def _spill(self, key, data):
+        if self.spill is None or data.size > len(self.spill):
+            return
+        start = self._allocate(data.size)
+        while start is None and self.spilled:
+            old_start, old_shape = self.spilled.popitem(last=False)[1]
+            self._release(old_start, int(np.prod(old_shape)))
+            start = self._allocate(data.size)
+        if start is None:
+            return
+        self.spill[start:start + data.size] = data.ravel()
+        self.spilled[key] = (start, data.shape)
+
+    def _allocate(self, size):
+        for n, (start, free_size) in enumerate(self.free):
+            if free_size >= size:
+                if free_size == size:
+                    del self.free[n]
+                else:
+                    self.free[n] = (start + size, free_size - size)
+                return start
+        return None
+
+    def _release(self, start, size):
+        # insert the extent and merge it with its neighbours
+        n = bisect.bisect(self.free, (start, size))
+        self.free.insert(n, (start, size))
+        if n + 1 < len(self.free) and start + size == self.free[n + 1][0]:
+            self.free[n] = (start, size + self.free.pop(n + 1)[1])
+        if n > 0 and self.free[n - 1][0] + self.free[n - 1][1] == start:
+            self.free[n - 1] = (self.free[n - 1][0], self.free[n - 1][1] + self.free.pop(n)[1])